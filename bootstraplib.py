@@ -1,19 +1,28 @@
 #!/bin/micropython
 
 import array
+import binascii
 import builtins
 import errno
 import ffi
 import json
 import os
+import struct
 import sys
 
 def main():
+    if len(sys.argv) > 2 and 'coldplug' == sys.argv[2]:
+        if coldplug() is None:
+            LIBC__exit(1)
+        return
+    trace('begin', 'find_data')
     try:
         device, fields, init, home, bundles = find_data()
     except (LookupError, OSError):
         print ('Data partition not found', file=sys.stderr)
         LIBC__exit(1)
+    finally:
+        trace('end', 'find_data')
     ld_linux = sys.argv[1] if len(sys.argv) > 1 else None
     data = { 'ld_linux': ld_linux,
                  'home': home,
@@ -29,10 +38,12 @@ def main():
         f.write(json.dumps(data))
     if init:
         print (f'Execute the setup script {init}')
+        trace('begin', 'setup_script')
         if ld_linux is None:
             status = LIBC_system(f'{sys.executable} {init}')
         else:
             status = LIBC_system(f'{ld_linux} {sys.executable} {init}')
+        trace('end', 'setup_script')
         if status != 0:
             LIBC__exit(status)
     elif home:
@@ -65,7 +76,42 @@ def find_data():
         if len(seq) > 1:
             uuid = seq[0] if uuid is None else uuid
             name = seq[1] if name is None else name
-    for device, fields in sorted(blkid()):
+    # a named disk is worth waiting for, usb-storage alone holds a stick
+    # back for a second or more before its block device shows up
+    settle = None if uuid else 1
+    try:
+        timeout = float(kernel_arguments['fresh_os.timeout'])
+        settle = None
+    except (KeyError, ValueError):
+        timeout = settle or 30
+    deadline, tried = monotonic() + timeout, set()
+    sock = uevent_socket()
+    trace('begin', 'wait_devices')
+    try:
+        while True:
+            devices = [(device, fields) for device, fields
+                       in probe_devices(uuid) if device not in tried]
+            result = search_data(devices, uuid, name, tried)
+            if result is not None:
+                return result
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            if wait_uevent(sock, min(remaining, 0.25)) and settle:
+                deadline = monotonic() + settle
+    finally:
+        trace('end', 'wait_devices')
+        if sock >= 0:
+            LIBC_close(sock)
+    result = search_data([(device, fields) for device, fields in blkid()
+                          if device not in tried], uuid, name, tried)
+    if result is None:
+        raise LookupError('not found')
+    return result
+
+def search_data(devices, uuid, name, tried):
+    for device, fields in devices:
+        tried.add(device)
         if device.startswith('/dev/loop') \
            or 'TYPE' not in fields \
            or 'swap' == fields['TYPE'] \
@@ -73,10 +119,12 @@ def find_data():
            or (uuid and uuid != fields['UUID']):
             continue
         init = home = bundles = None
+        load_filesystem(fields['TYPE'])
         if uuid:
-            status = LIBC_system(f'/bin/mount {device} /memory/data '
-                                 f'{fs_options(fields["TYPE"])}')
-            if status != 0:
+            try:
+                mount(device, '/memory/data', fields['TYPE'],
+                      fs_options(fields['TYPE']))
+            except OSError:
                 raise LookupError(uuid)
             try:
                 if name:
@@ -106,13 +154,12 @@ def find_data():
                         raise LookupError(uuid)
             finally:
                 if init is None and home is None:
-                    status = LIBC_system(f'/bin/umount /memory/data')
-                    if status != 0:
-                        raise OSError(errno.EIO, 'Input/output error')
+                    umount('/memory/data')
         else:
-            status = LIBC_system(f'/bin/mount {device} /memory/data '
-                                 f'{fs_options(fields["TYPE"])}')
-            if status != 0:
+            try:
+                mount(device, '/memory/data', fields['TYPE'],
+                      fs_options(fields['TYPE']))
+            except OSError:
                 continue
             try:
                 if name:
@@ -137,11 +184,7 @@ def find_data():
                     return device, fields, init, home, bundles
             finally:
                 if init is None and home is None:
-                    status = LIBC_system(f'/bin/umount /memory/data')
-                    if status != 0:
-                        raise OSError(errno.EIO, 'Input/output error')
-    else:
-        raise LookupError('not found')
+                    umount('/memory/data')
 
 def initialize(home):
     passwd = {}
@@ -171,12 +214,11 @@ def initialize(home):
             if not isdir(f'/memory/union/home/{user}/{dn}'):
                 continue
             makedirs(f'{home}/home/{user}/{dn}')
-            if gid is None:
-                LIBC_system(f'/bin/chown {uid} '
-                            f'"{home}/home/{user}/{dn}"')
-            else:
-                LIBC_system(f'/bin/chown {uid}:{gid} '
-                            f'"{home}/home/{user}/{dn}"')
+            try:
+                chown(f'{home}/home/{user}/{dn}', uid,
+                      -1 if gid is None else gid)
+            except OSError as err:
+                print (err, file=sys.stderr)
             escaped = dn.replace('\t', r'\011').replace(' ', r'\040')
             records.append(f'/run/initramfs{home}/home/{user}/{escaped} '
                            f'/home/{user}/{escaped} '
@@ -205,26 +247,416 @@ def get_arguments():
         args = json.loads(f.read())
     return args
 
-def mount_sorted_bundles_and_init_union(bundles):
-    mountpoints = []
+def mount_sorted_bundles_and_init_union(bundles, direct_io=None):
+    kernel_arguments = dict(cmdline())
+    if direct_io is None:
+        direct_io = kernel_arguments.get('fresh_os.loop_dio') \
+                    not in (None, '0', 'no', 'off')
+    if kernel_arguments.get('fresh_os.toram') not in (None, '0', 'no',
+                                                      'off'):
+        trace('begin', 'toram')
+        bundles = copy_to_ram(bundles, kernel_arguments['fresh_os.toram'])
+        trace('end', 'toram')
+    upperdir, workdir = '/memory/changes', '/memory/workdir'
+    changes = kernel_arguments.get('fresh_os.changes', 'tmpfs')
+    mode, _, spec = changes.partition(':')
+    if 'zram' == mode:
+        trace('begin', 'zram')
+        try:
+            upperdir, workdir = zram_changes(spec)
+        except (OSError, ValueError) as err:
+            print (f'* {err}, keeping the changes in tmpfs')
+        trace('end', 'zram')
+    elif 'disk' == mode:
+        trace('begin', 'disk')
+        try:
+            upperdir, workdir = disk_changes(spec)
+        except (OSError, ValueError) as err:
+            print (f'* {err}, keeping the changes in tmpfs')
+        trace('end', 'disk')
+    elif changes != 'tmpfs':
+        print (f'* Unknown fresh_os.changes={changes}, '
+               'keeping the changes in tmpfs')
+    mountpoints, loops, pids = [], [], []
+    try:
+        for bundle, mountpoint in bundles:
+            try:
+                os.mkdir(mountpoint)
+            except OSError as err:
+                if err.args[0] != errno.EEXIST:
+                    raise err
+            try:
+                loop_fd, device = attach_loop(bundle, direct_io)
+            except OSError:
+                loop_fd, device = -1, None
+            loops.append(loop_fd)
+            pid = LIBC_fork()
+            if 0 == pid:
+                trace('begin', f'mount {bundle}')
+                if device is None:
+                    status = LIBC_system(
+                             '/bin/mount -o loop,ro -t squashfs '
+                             f'"{bundle}" "{mountpoint}"')
+                elif LIBC_mount(device, mountpoint, 'squashfs',
+                                MS_RDONLY, '') != 0:
+                    status = os.errno()
+                else:
+                    status = 0
+                trace('end', f'mount {bundle}')
+                LIBC__exit(status)
+            elif pid < 0:
+                raise OSError(os.errno())
+            pids.append((pid, bundle))
+            mountpoints.append(mountpoint)
+        for pid, bundle in pids:
+            if waitpid(pid) != 0:
+                raise OSError(errno.EIO, f'Failed to mount {bundle}')
+            print (f'* {bundle.rsplit("/", 1)[-1]}')
+        pids = []
+    finally:
+        for pid, _ in pids:
+            waitpid(pid)
+        for loop_fd in loops:
+            if loop_fd >= 0:
+                LIBC_close(loop_fd)
+    lowerdir = ':'.join(reversed(mountpoints))
+    trace('begin', 'mount_union')
+    try:
+        mount('overlay', '/memory/union', 'overlay',
+              f'lowerdir={lowerdir},upperdir={upperdir},'
+              f'workdir={workdir}')
+    except OSError as err:
+        raise OSError(err.args[0], 'Union file system mount failed')
+    trace('end', 'mount_union')
+
+def copy_to_ram(bundles, patterns='', jobs=4):
+    patterns = [pattern for pattern in patterns.split(',')
+                if pattern not in ('', '1', 'yes', 'on', 'all')]
+    selected, result = [], []
     for bundle, mountpoint in bundles:
+        fn = bundle.rsplit('/', 1)[-1]
+        if not patterns or any(fnmatch(fn, pattern)
+                               for pattern in patterns):
+            try:
+                selected.append((bundle, os.stat(bundle)[6]))
+            except OSError:
+                continue
+    memory = meminfo()
+    budget = memory.get('MemAvailable', memory.get('MemFree', 0)) \
+             - memory.get('MemTotal', 0) // 4
+    copies = {}
+    for bundle, size in selected:
+        if size > budget:
+            print (f'* Not enough memory to copy {bundle} to RAM')
+            continue
+        budget -= size
+        copies[bundle] = (f'/memory/toram/{len(copies):02}-'
+                          + bundle.rsplit('/', 1)[-1], size)
+    if copies:
+        makedirs('/memory/toram')
+        total = sum(size for _, size in copies.values())
+        pending, running, failed = list(copies), {}, set()
+        wstatus = array.array('i', [0])
+        while pending or running:
+            while pending and len(running) < jobs:
+                bundle = pending.pop(0)
+                pid = LIBC_fork()
+                if 0 == pid:
+                    status = errno.EIO
+                    try:
+                        status = copy_file(bundle, copies[bundle][0])
+                    finally:
+                        LIBC__exit(status)
+                elif pid < 0:
+                    failed.add(bundle)
+                else:
+                    running[pid] = bundle
+            for pid in list(running):
+                if LIBC_waitpid(pid, wstatus, WNOHANG) == pid:
+                    if wstatus[0] != 0:
+                        failed.add(running[pid])
+                    del running[pid]
+            done = 0
+            for dst, size in copies.values():
+                for fn in (dst, f'{dst}.part'):
+                    try:
+                        done += os.stat(fn)[6]
+                    except OSError:
+                        pass
+            print (f'\r\033[0;32m* \033[0;39mCopying to RAM '
+                   f'{done >> 20}/{total >> 20} MiB', end='')
+            if running:
+                LIBC_usleep(200000)
+        print ()
+        for bundle in failed:
+            print (f'* Failed to copy {bundle} to RAM')
+            try:
+                os.remove(f'{copies.pop(bundle)[0]}.part')
+            except OSError:
+                pass
+    for bundle, mountpoint in bundles:
+        if bundle in copies:
+            result.append((copies[bundle][0], mountpoint))
+        else:
+            result.append((bundle, mountpoint))
+    return result
+
+def zram_changes(spec, mountpoint='/memory/zram'):
+    size, _, algorithm = spec.partition(',')
+    if not size or size.endswith('%'):
+        percent = int(size[:-1]) if size else 100
+        size = str(meminfo().get('MemTotal', 0) * percent // 100)
+    if not isdir('/sys/class/zram-control'):
+        LIBC_system('/sbin/modprobe -q zram num_devices=0')
+    with open('/sys/class/zram-control/hot_add') as f:
+        number = int(f.read())
+    block, device = f'/sys/block/zram{number}', f'/dev/zram{number}'
+    try:
+        if algorithm:
+            with open(f'{block}/comp_algorithm', 'w') as f:
+                f.write(algorithm)
+        with open(f'{block}/disksize', 'w') as f:
+            f.write(size)
+        if not isblock(device) and LIBC_mknod is not None:
+            with open(f'{block}/dev') as f:
+                major, minor = [int(n) for n in f.read().split(':')]
+            LIBC_mknod(device, 0o060660, major << 8 | minor & 0xff
+                       | (minor & ~0xff) << 12)
+        # zram has 4 KiB logical blocks, smaller file system blocks fail
+        if LIBC_system(f'/bin/mke2fs -b 4096 -m 0 -I 256 -L changes '
+                       f'{device} >/dev/null') != 0:
+            raise OSError(errno.EIO, f'Failed to format {device}')
+        makedirs(mountpoint)
+        try:
+            mount(device, mountpoint, 'ext4', 'noatime')
+        except OSError:
+            mount(device, mountpoint, 'ext2', 'noatime')
+    except OSError as err:
         try:
-            os.mkdir(mountpoint)
+            with open('/sys/class/zram-control/hot_remove', 'w') as f:
+                f.write(str(number))
+        except OSError:
+            pass
+        raise OSError(err.args[0], f'Failed to set up {device}')
+    os.mkdir(f'{mountpoint}/changes')
+    os.mkdir(f'{mountpoint}/workdir')
+    # savechanges keeps reading the upper layer from /memory/changes
+    mount(f'{mountpoint}/changes', '/memory/changes', '', 'bind')
+    print (f'* Changes are kept in the compressed {device}')
+    return f'{mountpoint}/changes', f'{mountpoint}/workdir'
+
+def disk_changes(spec, mountpoint='/memory/disk'):
+    args = get_arguments()
+    home, typ = args['home'], args.get('device_TYPE')
+    if typ in NATIVE_FILESYSTEMS:
+        upperdir, workdir = f'{home}/changes', f'{home}/workdir'
+        makedirs(upperdir)
+        makedirs(workdir)
+        mount(upperdir, '/memory/changes', '', 'bind')
+        print (f'* Changes are kept in {upperdir}')
+        return upperdir, workdir
+    image = f'{home}/changes.img'
+    created = not isfile(image)
+    if created:
+        size = parse_size(spec) if spec else 1 << 30
+        if 'vfat' == typ:
+            size = min(size, FAT_MAX_IMAGE)
+        with open(image, 'wb'):
+            pass
+        if LIBC_truncate(image, size - size % 4096) != 0:
+            err = os.errno()
+            os.remove(image)
+            raise OSError(err, f'Failed to create {image}')
+    loop_fd, device = attach_loop(image, read_only=False)
+    try:
+        if created:
+            if LIBC_system(f'/bin/mke2fs -b 4096 -m 0 -I 256 -L changes '
+                           f'{device} >/dev/null') != 0:
+                os.remove(image)
+                raise OSError(errno.EIO, f'Failed to format {image}')
+        elif not ext_clean(image):
+            fsck(device, image, args.get('ld_linux'))
+        makedirs(mountpoint)
+        try:
+            mount(device, mountpoint, 'ext4', 'noatime')
+        except OSError:
+            mount(device, mountpoint, 'ext2', 'noatime')
+        try:
+            grow_image(image, loop_fd, mountpoint, typ)
         except OSError as err:
-            if err.args[0] != errno.EEXIST:
-                raise err
-        if LIBC_system('/bin/mount -o loop,ro -t squashfs '
-                       f'"{bundle}" "{mountpoint}"') != 0:
-            raise OSError(errno.EIO, 'Failed to mount {bundle}')
-        print (f'* {bundle.rsplit("/", 1)[-1]}')
-        mountpoints.append(mountpoint)
-    lowerdir = ':'.join(reversed(mountpoints))
-    if LIBC_system(f'mount -t overlay overlay -o lowerdir={lowerdir},'
-                   f'upperdir=/memory/changes,workdir=/memory/workdir'
-                   ' /memory/union') != 0:
-        raise OSError(errno.EIO, 'Union file system mount failed')
+            print (f'* {err}')
+    finally:
+        LIBC_close(loop_fd)
+    upperdir, workdir = f'{mountpoint}/changes', f'{mountpoint}/workdir'
+    makedirs(upperdir)
+    makedirs(workdir)
+    mount(upperdir, '/memory/changes', '', 'bind')
+    print (f'* Changes are kept in {image}')
+    return upperdir, workdir
+
+def ext_clean(path):
+    with open(path, 'rb') as f:
+        f.seek(1024)
+        head = f.read(64)
+    if len(head) < 64:
+        return False
+    magic, state = struct.unpack_from('<HH', head, 56)
+    # valid and without errors, the driver clears it while mounted
+    return 0xef53 == magic and 1 == state & 3
+
+def fsck(device, image, ld_linux=None):
+    if not isfile('/sbin/e2fsck'):
+        print (f'* {image} was not unmounted cleanly, no e2fsck to check it')
+        return
+    print (f'* Checking {image}')
+    cmd = f'/sbin/e2fsck -p {device}'
+    status = LIBC_system(cmd if ld_linux is None else f'{ld_linux} {cmd}')
+    # 1 and 2 mean errors were corrected, 4 and more that some are left
+    if status >> 8 >= 4 or status & 0xff:
+        raise OSError(errno.EIO, f'Failed to check {image}')
+
+def grow_image(image, loop_fd, mountpoint, typ=None):
+    _, frsize, blocks, _, available = os.statvfs(mountpoint)[:5]
+    with open(image, 'rb') as f:
+        f.seek(1024)
+        head = f.read(32)
+    blocks_count, log_block_size = struct.unpack_from('<I16xI', head, 4)
+    size = os.stat(image)[6]
+    if blocks_count << 10 + log_block_size < size:
+        # the image was grown, but the file system not, finish it
+        new_size = size
+    elif available * 4 >= blocks:
+        return
+    else:
+        data = os.statvfs('/memory/data')
+        new_size = min(size * 2, size + data[4] * data[1] // 2)
+        if 'vfat' == typ:
+            new_size = min(new_size, FAT_MAX_IMAGE)
+        new_size -= new_size % frsize
+        if new_size <= size:
+            return
+        print (f'* Growing {image} to {new_size >> 20} MiB')
+        if LIBC_truncate(image, new_size) != 0 \
+           or LIBC_ioctl(loop_fd, LOOP_SET_CAPACITY, 0) != 0:
+            raise OSError(os.errno(), f'Failed to grow {image}')
+    fd = LIBC_open(mountpoint, O_RDONLY | O_CLOEXEC, 0)
+    if fd < 0:
+        raise OSError(os.errno(), f'Failed to grow {image}')
+    try:
+        if LIBC_ioctl(fd, EXT4_IOC_RESIZE_FS,
+                      struct.pack('Q', new_size // frsize)) != 0:
+            raise OSError(os.errno(), f'Failed to grow {image}')
+    finally:
+        LIBC_close(fd)
+
+def parse_size(text):
+    units = 'KMGT'
+    if text[-1:].upper() in units:
+        return int(text[:-1]) << 10 * (units.index(text[-1].upper()) + 1)
+    return int(text)
+
+def meminfo():
+    result = {}
+    with open('/proc/meminfo') as f:
+        for row in f:
+            seq = row.split()
+            if len(seq) > 1:
+                result[seq[0].rstrip(':')] = int(seq[1]) * 1024
+    return result
+
+def copy_file(src, dst, size=1 << 23):
+    fd_in = LIBC_open(src, O_RDONLY | O_CLOEXEC, 0)
+    if fd_in < 0:
+        return os.errno()
+    try:
+        LIBC_posix_fadvise(fd_in, 0, 0, POSIX_FADV_SEQUENTIAL)
+        fd_out = LIBC_open(f'{dst}.part',
+                           O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, 0o644)
+        if fd_out < 0:
+            return os.errno()
+        try:
+            while True:
+                n = LIBC_sendfile(fd_out, fd_in, None, size)
+                if n < 0:
+                    return os.errno()
+                elif 0 == n:
+                    break
+        finally:
+            LIBC_close(fd_out)
+    finally:
+        LIBC_close(fd_in)
+    try:
+        os.rename(f'{dst}.part', dst)
+    except OSError as err:
+        return err.args[0]
+    return 0
+
+def attach_loop(path, direct_io=False, read_only=True):
+    fd = LIBC_open(path, (O_RDONLY if read_only else O_RDWR) | O_CLOEXEC, 0)
+    if fd < 0:
+        raise OSError(os.errno())
+    try:
+        control = LIBC_open('/dev/loop-control', O_RDWR | O_CLOEXEC, 0)
+        if control < 0:
+            raise OSError(os.errno())
+        try:
+            for _ in range(8):
+                number = LIBC_ioctl(control, LOOP_CTL_GET_FREE, 0)
+                if number < 0:
+                    raise OSError(os.errno())
+                device = f'/dev/loop{number}'
+                if not isblock(device) and LIBC_mknod is not None:
+                    LIBC_mknod(device, 0o060660, 7 << 8 | number & 0xff
+                               | (number & ~0xff) << 12)
+                loop_fd = LIBC_open(device, O_RDWR | O_CLOEXEC, 0)
+                if loop_fd < 0:
+                    raise OSError(os.errno())
+                config = loop_config(fd, path, direct_io, read_only)
+                if LIBC_ioctl(loop_fd, LOOP_CONFIGURE, config) == 0:
+                    return loop_fd, device
+                err = os.errno()
+                LIBC_close(loop_fd)
+                if err != errno.EBUSY:
+                    raise OSError(err)
+            raise OSError(errno.EBUSY)
+        finally:
+            LIBC_close(control)
+    finally:
+        LIBC_close(fd)
+
+def loop_config(fd, path, direct_io=False, read_only=True):
+    flags = LO_FLAGS_AUTOCLEAR
+    if read_only:
+        flags |= LO_FLAGS_READ_ONLY
+    block_size = 0
+    if direct_io:
+        flags |= LO_FLAGS_DIRECT_IO
+        block_size = logical_block_size(path)
+    config = bytearray(304)
+    struct.pack_into('II', config, 0, fd, block_size)
+    struct.pack_into('I', config, 8 + 52, flags)
+    name = path.encode()[:63]
+    config[8+56:8+56+len(name)] = name
+    return config
+
+def logical_block_size(path):
+    dev = os.stat(path)[2]
+    major = (dev >> 8) & 0xfff | (dev >> 32) & ~0xfff
+    minor = dev & 0xff | (dev >> 12) & ~0xff
+    for fn in (f'/sys/dev/block/{major}:{minor}/queue/logical_block_size',
+               f'/sys/dev/block/{major}:{minor}/../queue/'
+               'logical_block_size'):
+        try:
+            with open(fn) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            continue
+    return 0
 
 def find_sorted_bundles(home):
+    bundles = read_manifest(home)
+    if bundles is not None:
+        return bundles
     bundles = []
     for fn in sorted(os.listdir(home)):
         if not fn.endswith('.sb') or '.sb' == fn:
@@ -242,12 +674,35 @@ def find_sorted_bundles(home):
                                 f'/memory/bundles/snapshots/{base}'))
     return bundles
 
+def read_manifest(home):
+    try:
+        with open(f'{home}/bundles.json') as f:
+            manifest = json.loads(f.read())
+        if manifest['version'] != 1 \
+           or os.stat(home)[8] != os.stat(f'{home}/bundles.json')[8]:
+            return None
+        try:
+            snapshots = os.stat(f'{home}/snapshots')[8]
+        except OSError:
+            snapshots = None
+        if manifest['snapshots'] != snapshots:
+            return None
+        bundles = []
+        for bundle in manifest['bundles']:
+            path = bundle['path']
+            if bundle['squashfs'] is None \
+               or bundle['squashfs']['bytes_used'] > bundle['size']:
+                print (f'* Skip {path}, not a complete squashfs image')
+                continue
+            base = path.rsplit('.', 1)[0]
+            bundles.append((f'{home}/{path}', f'/memory/bundles/{base}'))
+        return bundles
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
 def remount_data(args, options):
-    if LIBC_system(f'/bin/umount /memory/data') != 0:
-        raise OSError(errno.EIO, f'Failed to umount {args["device"]}')
-    if LIBC_system(f'/bin/mount -o {options} -t {args["device_TYPE"]} '
-                   f'{args["device"]} /memory/data') != 0:
-        raise OSError(errno.EIO, f'Failed to mount {args["device"]}')
+    umount('/memory/data')
+    mount(args['device'], '/memory/data', args['device_TYPE'], options)
 
 def install_scripts():
     if not isdir('/memory/union/usr/bin'):
@@ -256,9 +711,154 @@ def install_scripts():
         os.mkdir('/memory/union/usr/bin')
     for fn in ('dir2sb initramfs_pack initramfs_unpack rmsbdir '
                'savechanges sb sb2dir').split():
-        LIBC_system(f'/bin/cp /usr/share/fresh_os/{fn} '
-                    '/memory/union/usr/bin && '
-                    f'chmod 0755 /memory/union/usr/bin/{fn}')
+        status = copy_file(f'/usr/share/fresh_os/{fn}',
+                           f'/memory/union/usr/bin/{fn}')
+        if status != 0:
+            print (OSError(status, f'Failed to install {fn}'),
+                   file=sys.stderr)
+            continue
+        chmod(f'/memory/union/usr/bin/{fn}', 0o755)
+
+def coldplug(passes=8):
+    modules = module_aliases()
+    if modules is None:
+        return None
+    aliases, paths = modules
+    loaded, matches = set(), {}
+    for _ in range(passes):
+        names = set()
+        for modalias in modaliases('/sys/devices'):
+            if modalias not in matches:
+                matches[modalias] = match_modalias(aliases, modalias)
+            names.update(name for name in matches[modalias]
+                         if name not in loaded
+                         and '/drivers/net/' not in paths.get(name, ''))
+        if not names:
+            break
+        loaded.update(names)
+        LIBC_system('/sbin/modprobe -a -q ' + ' '.join(sorted(names)))
+    return sorted(loaded)
+
+def match_modalias(aliases, modalias):
+    prefix = modalias.split(':', 1)[0]
+    return set(name for pattern, name
+               in aliases.get(modalias[:len(prefix) + ALIAS_KEY], [])
+               + aliases.get(prefix, []) + aliases.get('', [])
+               if fnmatch(modalias, pattern))
+
+def module_aliases():
+    with open('/proc/sys/kernel/osrelease') as f:
+        base = f'/lib/modules/{f.read().strip()}'
+    aliases, paths = {}, {}
+    try:
+        with open(f'{base}/modules.dep') as f:
+            for row in f:
+                path = row.split(':', 1)[0]
+                paths[module_name(path)] = path
+        with open(f'{base}/modules.alias') as f:
+            for row in f:
+                seq = row.split()
+                if 3 == len(seq) and 'alias' == seq[0]:
+                    aliases.setdefault(alias_key(seq[1]), []) \
+                        .append((seq[1], module_name(seq[2])))
+    except OSError:
+        return None
+    return aliases, paths
+
+def alias_key(pattern):
+    # most aliases are pci: or usb: ones, so also key them by the
+    # vendor id that follows when it is literal
+    prefix = pattern
+    for c in ':*?[':
+        prefix = prefix.split(c, 1)[0]
+    key = pattern[:len(prefix) + ALIAS_KEY]
+    if len(key) == len(prefix) + ALIAS_KEY and ':' == key[len(prefix)] \
+       and not any(c in key for c in '*?[\\'):
+        return key
+    return prefix
+
+def modaliases(path):
+    result = []
+    for entry in os.ilistdir(path):
+        if 0o040000 == entry[1]:
+            result.extend(modaliases(f'{path}/{entry[0]}'))
+        elif 'modalias' == entry[0]:
+            try:
+                with open(f'{path}/modalias') as f:
+                    modalias = f.read().strip()
+            except OSError:
+                continue
+            if modalias:
+                result.append(modalias)
+    return result
+
+def module_name(path):
+    name = path.rsplit('/', 1)[-1].split('.ko', 1)[0]
+    return name.replace('-', '_')
+
+def fnmatch(name, pattern):
+    i, j, star, mark = 0, 0, -1, 0
+    while i < len(name):
+        if j < len(pattern) and '*' == pattern[j]:
+            star, mark, j = j, i, j + 1
+            continue
+        k = fnmatch_char(name[i], pattern, j)
+        if k >= 0:
+            i, j = i + 1, k
+        elif star >= 0:
+            mark += 1
+            i, j = mark, star + 1
+        else:
+            return False
+    while j < len(pattern) and '*' == pattern[j]:
+        j += 1
+    return j == len(pattern)
+
+def fnmatch_char(c, pattern, j):
+    if j >= len(pattern):
+        return -1
+    if '?' == pattern[j]:
+        return j + 1
+    if '[' == pattern[j]:
+        k = pattern.find(']', j + 2)
+        if k > 0:
+            chars = pattern[j+1:k]
+            negate = chars[0] in '!^'
+            if negate:
+                chars = chars[1:]
+            found, n = False, 0
+            while n < len(chars):
+                if n + 2 < len(chars) and '-' == chars[n+1]:
+                    found = found or chars[n] <= c <= chars[n+2]
+                    n += 3
+                else:
+                    found = found or c == chars[n]
+                    n += 1
+            return k + 1 if found != negate else -1
+    return j + 1 if c == pattern[j] else -1
+
+def load_filesystem(typ):
+    with open('/proc/filesystems') as f:
+        for row in f:
+            if typ == row.split('\t')[-1].strip():
+                return
+    LIBC_system(f'/sbin/modprobe -q fs-{typ}')
+
+def monotonic():
+    ts = array.array('q', [0, 0])
+    if LIBC_clock_gettime(CLOCK_BOOTTIME, ts) != 0:
+        raise OSError(os.errno())
+    return ts[0] + ts[1] / 1000000000
+
+def trace(event, name):
+    ts = array.array('q', [0, 0])
+    if LIBC_clock_gettime(CLOCK_BOOTTIME, ts) != 0:
+        return
+    try:
+        with open('/memory/boot.trace', 'a') as f:
+            f.write(f'{ts[0]}.{ts[1] // 1000:06d} {event} {name}\n')
+    except OSError:
+        pass
 
 def cmdline():
     with open('/proc/cmdline') as f:
@@ -282,8 +882,168 @@ def blkid():
             ))
     return sorted(devices)
 
+def probe_devices(uuid=None, cache='/memory/devices.json'):
+    try:
+        with open(cache) as f:
+            cached = json.loads(f.read())
+    except (OSError, ValueError):
+        cached = {}
+    with open('/proc/partitions') as f:
+        rows = f.read().split('\n')[2:]
+    devices, probed = [], {}
+    for row in rows:
+        seq = row.split()
+        if 4 != len(seq) or seq[3].startswith('loop') \
+           or seq[3].startswith('ram'):
+            continue
+        device, key = f'/dev/{seq[3]}', ':'.join(seq[0:3])
+        if device in cached and key == cached[device][0]:
+            fields = cached[device][1]
+        else:
+            try:
+                fields = probe(device)
+            except OSError:
+                continue
+        probed[device] = [key, fields]
+        if fields:
+            devices.append((device, fields))
+            if uuid and uuid == fields.get('UUID'):
+                devices = [(device, fields)]
+                break
+    cached.update(probed)
+    try:
+        with open(cache, 'w') as f:
+            f.write(json.dumps(cached))
+    except OSError:
+        pass
+    return sorted(devices)
+
+def uevent_socket():
+    sock = LIBC_socket(AF_NETLINK, SOCK_DGRAM | SOCK_CLOEXEC,
+                       NETLINK_KOBJECT_UEVENT)
+    if sock < 0:
+        return sock
+    address = struct.pack('HHII', AF_NETLINK, 0, 0, 1)
+    if LIBC_bind(sock, address, len(address)) != 0:
+        LIBC_close(sock)
+        return -1
+    return sock
+
+def wait_uevent(sock, timeout):
+    if sock < 0:
+        LIBC_usleep(int(timeout * 1000000))
+        return []
+    events, buf = [], bytearray(8192)
+    pollfd = bytearray(struct.pack('ihh', sock, POLLIN, 0))
+    while LIBC_poll(pollfd, 1, int(timeout * 1000)) > 0:
+        size = LIBC_recv(sock, buf, len(buf), 0)
+        if size <= 0:
+            break
+        fields = bytes(buf[:size]).split(b'\0')
+        if b'SUBSYSTEM=block' in fields:
+            events.append(fields[0].decode())
+        timeout = 0
+    return events
+
+def probe(device):
+    with open(device, 'rb') as f:
+        head = f.read(4096)
+        f.seek(32768)
+        volume = f.read(2048)
+    for prober in (probe_ext, probe_f2fs, probe_squashfs, probe_exfat,
+                   probe_ntfs, probe_iso9660, probe_vfat):
+        try:
+            fields = prober(head, volume)
+        except (IndexError, ValueError):
+            continue
+        if fields:
+            return fields
+
+def probe_ext(head, volume):
+    if head[1080:1082] != b'\x53\xef':
+        return None
+    compat, incompat, ro_compat = struct.unpack('<III', head[1116:1128])
+    if incompat & 0x0008:
+        return None
+    if incompat & ~0x0016 or ro_compat & ~0x0007:
+        typ = 'ext4'
+    elif compat & 0x0004:
+        typ = 'ext3'
+    else:
+        typ = 'ext2'
+    return label({'TYPE': typ, 'UUID': format_uuid(head[1128:1144])},
+                 head[1144:1160])
+
+def probe_f2fs(head, volume):
+    if head[1024:1028] != b'\x10\x20\xf5\xf2':
+        return None
+    fields = {'TYPE': 'f2fs', 'UUID': format_uuid(head[1132:1148])}
+    name = head[1148:1660]
+    end = 0
+    while end < len(name) and name[end:end+2] != b'\0\0':
+        end += 2
+    return label(fields, bytes(name[i] for i in range(0, end, 2)))
+
+def probe_squashfs(head, volume):
+    if head[0:4] != b'hsqs':
+        return None
+    return {'TYPE': 'squashfs'}
+
+def probe_exfat(head, volume):
+    if head[3:11] != b'EXFAT   ':
+        return None
+    serial, = struct.unpack('<I', head[100:104])
+    return {'TYPE': 'exfat',
+            'UUID': f'{serial >> 16:04X}-{serial & 0xffff:04X}'}
+
+def probe_ntfs(head, volume):
+    if head[3:11] != b'NTFS    ':
+        return None
+    serial, = struct.unpack('<Q', head[72:80])
+    return {'TYPE': 'ntfs', 'UUID': f'{serial:016X}'}
+
+def probe_iso9660(head, volume):
+    if volume[0:6] != b'\x01CD001':
+        return None
+    # blkid takes the modification date, the creation date if unset
+    date = volume[830:846]
+    if not date.strip(b'0\0'):
+        date = volume[813:829]
+    date = date.decode()
+    uuid = '-'.join([date[0:4]] + [date[i:i+2] for i in range(4, 16, 2)])
+    return label({'TYPE': 'iso9660', 'UUID': uuid}, volume[40:72])
+
+def probe_vfat(head, volume):
+    if head[510:512] != b'\x55\xaa':
+        return None
+    if head[82:87] == b'FAT32':
+        serial, name = head[67:71], head[71:82]
+    elif head[54:57] == b'FAT':
+        serial, name = head[39:43], head[43:54]
+    else:
+        return None
+    serial, = struct.unpack('<I', serial)
+    fields = {'TYPE': 'vfat',
+              'UUID': f'{serial >> 16:04X}-{serial & 0xffff:04X}'}
+    if name != b'NO NAME    ':
+        label(fields, name)
+    return fields
+
+def format_uuid(data):
+    h = binascii.hexlify(data).decode()
+    return f'{h[0:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:32]}'
+
+def label(fields, data):
+    try:
+        name = data.split(b'\0', 1)[0].decode().strip()
+    except UnicodeError:
+        name = ''
+    if name:
+        fields['LABEL'] = name
+    return fields
+
 def fs_options(typ):
-    options = f'-t {typ} -o rw'
+    options = 'rw'
     if 'vfat' == typ:
         options += ',check=s,shortname=mixed,iocharset=utf8'
     return options
@@ -331,6 +1091,32 @@ def parse_cmdline(data):
         result.append((''.join(key), ''.join(value)))
     return result
 
+def mount(source, target, typ, options=''):
+    flags, data = 0, []
+    for option in options.split(','):
+        if option in ('', 'defaults'):
+            continue
+        elif 'rw' == option:
+            flags &= ~MS_RDONLY
+        elif option in MOUNT_FLAGS:
+            flags |= MOUNT_FLAGS[option]
+        else:
+            data.append(option)
+    if LIBC_mount(source, target, typ, flags, ','.join(data)) != 0:
+        raise OSError(os.errno(), f'Failed to mount {source} on {target}')
+
+def umount(target, flags=0):
+    if LIBC_umount2(target, flags) != 0:
+        raise OSError(os.errno(), f'Failed to umount {target}')
+
+def chown(path, uid, gid=-1):
+    if LIBC_chown(path, uid, gid) != 0:
+        raise OSError(os.errno(), f'Failed to chown {path}')
+
+def chmod(path, mode):
+    if LIBC_chmod(path, mode) != 0:
+        raise OSError(os.errno(), f'Failed to chmod {path}')
+
 def popen(cmd):
     pair = array.array('i', [0, 0])
     if LIBC_pipe(pair) != 0:
@@ -379,6 +1165,12 @@ def isfile(path):
     except OSError:
         return False
 
+def isblock(path):
+    try:
+        return 0o060000 == os.stat(path)[0] & 0o170000
+    except OSError:
+        return False
+
 def ismount(mountpoint):
     with open('/proc/mounts') as f:
         data = f.read()
@@ -391,12 +1183,56 @@ def ismount(mountpoint):
 
 LIBC = ffi.open('libc.so.6')
 LIBC__exit = LIBC.func('v', '_exit', 'i')
+LIBC_bind = LIBC.func('i', 'bind', 'ipi')
+LIBC_chmod = LIBC.func('i', 'chmod', 'sI')
+LIBC_chown = LIBC.func('i', 'chown', 'sii')
+LIBC_clock_gettime = LIBC.func('i', 'clock_gettime', 'ip')
 LIBC_close = LIBC.func("i", "close", "i")
 LIBC_dup2 = LIBC.func('i', 'dup2', 'ii')
 LIBC_fork = LIBC.func('i', 'fork', '')
+LIBC_ioctl = LIBC.func('i', 'ioctl', 'iLp')
+LIBC_mount = LIBC.func('i', 'mount', 'sssLs')
+try:
+    LIBC_mknod = LIBC.func('i', 'mknod', 'siQ')
+except OSError:
+    LIBC_mknod = None
+LIBC_open = LIBC.func('i', 'open', 'sii')
 LIBC_pipe = LIBC.func('i', 'pipe', 'p')
+LIBC_poll = LIBC.func('i', 'poll', 'pii')
+LIBC_posix_fadvise = LIBC.func('i', 'posix_fadvise', 'iqqi')
+LIBC_recv = LIBC.func('i', 'recv', 'ipii')
+LIBC_sendfile = LIBC.func('l', 'sendfile', 'iipL')
+LIBC_socket = LIBC.func('i', 'socket', 'iii')
 LIBC_system = LIBC.func('i', 'system', 's')
+LIBC_truncate = LIBC.func('i', 'truncate', 'sq')
+LIBC_umount2 = LIBC.func('i', 'umount2', 'si')
+LIBC_usleep = LIBC.func('i', 'usleep', 'I')
 LIBC_waitpid = LIBC.func('i', 'waitpid', 'ipi')
+AF_NETLINK, NETLINK_KOBJECT_UEVENT = 16, 15
+ALIAS_KEY = len(':v00008086')
+CLOCK_BOOTTIME = 7
+EXT4_IOC_RESIZE_FS = 0x40086610
+FAT_MAX_IMAGE = (4 << 30) - 4096
+LOOP_CONFIGURE, LOOP_CTL_GET_FREE = 0x4C0A, 0x4C82
+LOOP_SET_CAPACITY = 0x4C07
+LO_FLAGS_READ_ONLY, LO_FLAGS_AUTOCLEAR, LO_FLAGS_DIRECT_IO = 1, 4, 16
+MS_RDONLY = 1
+MOUNT_FLAGS = {     'ro': MS_RDONLY,
+                  'bind': 4096,
+                'nosuid': 2,
+                 'nodev': 4,
+                'noexec': 8,
+                  'sync': 16,
+               'noatime': 1024,
+            'nodiratime': 2048,
+              'relatime': 1 << 21 }
+O_RDONLY, O_WRONLY, O_RDWR = 0, 1, 2
+O_CREAT, O_TRUNC, O_CLOEXEC = 0o100, 0o1000, 0o2000000
+POLLIN = 1
+POSIX_FADV_SEQUENTIAL = 2
+WNOHANG = 1
+NATIVE_FILESYSTEMS = ('btrfs', 'ext2', 'ext3', 'ext4', 'f2fs', 'xfs')
+SOCK_DGRAM, SOCK_CLOEXEC = 2, 0o2000000
 default_py_in = '''#!/bin/micropython\n
 import bootstraplib
 
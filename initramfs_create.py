@@ -1,34 +1,362 @@
 #!/usr/bin/python3
 
+import concurrent.futures
+import contextlib
 import errno
+import fnmatch
 import glob
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import lzma
 import os
 import re
 import shutil
 import stat
+import struct
 import subprocess
 import sys
 import tempfile
+import time
 
-def build(output):
+def build(output, cache=None, module_mode='decompress', hostonly=False,
+          compress='xz', resolver=None, userspace=None, report=None):
     if os.path.exists(output):
         raise FileExistsError(errno.EEXIST, f'File "{output}" exists')
+    compressor, _ = get_compressor(compress)
     static = os.path.abspath(os.path.join(
              os.path.dirname(__file__), 'assets'))
+    check_module_mode(module_mode)
+    if report is None:
+        report = BuildReport()
+    report.release, report.output = RELEASE, output
+    with report.phase('collect'):
+        dependency = collect_dependencies(static, hostonly, resolver)
+    if cache is not None:
+        with report.phase('cache'):
+            key = cache.fingerprint(static, dependency, module_mode,
+                                    compress)
+            hit = cache.restore_image(key, output)
+        if hit:
+            report.count('image_bytes', os.path.getsize(output))
+            return report
+        temp_dir_holder = smart_temporary_directory(cache.temp_dir)
+    else:
+        temp_dir_holder = smart_temporary_directory()
+    temp_dir = next(temp_dir_holder).rstrip('/')
+    if cache is None:
+        archive = stage(static, dependency, temp_dir, cache, module_mode,
+                        userspace, report)
+        with report.phase('overlay'):
+            stage_overlay(static, archive, report)
+        report.count('staging_peak_bytes', tree_size(temp_dir))
+        with report.phase('archive'), open(output, 'wb') as f:
+            report.count('archive_bytes',
+                         compress_archive(archive, f, compressor))
+        report.count('files', len(archive.entries))
+    else:
+        with report.phase('cache'):
+            base_key = cache.fingerprint(static, dependency, module_mode,
+                                         compress, overlay=False)
+            segment = cache.lookup_segment(base_key)
+        if segment is None:
+            archive = stage(static, dependency, temp_dir, cache,
+                            module_mode, userspace, report)
+            report.count('staging_peak_bytes', tree_size(temp_dir))
+            with report.phase('archive'):
+                segment, size = cache.store_segment(base_key, archive,
+                                                    compressor)
+            report.count('archive_bytes', size)
+            report.count('files', len(archive.entries))
+        with report.phase('overlay'), open(output, 'wb') as f:
+            overlay = stage_overlay(static, Archive(), report)
+            with open(segment, 'rb') as f_in:
+                shutil.copyfileobj(f_in, f, 1 << 20)
+            report.count('archive_bytes',
+                         compress_archive(overlay, f, compressor))
+        report.count('files', len(overlay.entries))
+    report.count('image_bytes', os.path.getsize(output))
+    if cache is not None:
+        with report.phase('cache'):
+            cache.store_image(key, output)
+    return report
+
+def compile_mpy(static, src, report=None):
+    mpy_cross = shutil.which('mpy-cross')
+    if mpy_cross is None:
+        return None
+    micropython = os.path.join(static, 'micropython')
+    try:
+        version = int(run(f'{micropython} -c "import sys; '
+                          f'print(sys.implementation._mpy)"').stdout)
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+    name = os.path.basename(src)
+    module = name.rsplit('.', 1)[0]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for dn in ('py', 'mpy'):
+            os.mkdir(os.path.join(temp_dir, dn))
+        shutil.copy(src, os.path.join(temp_dir, 'py', name))
+        dst = os.path.join(temp_dir, 'mpy', f'{module}.mpy')
+        subprocess.run([mpy_cross, '-s', name, '-o', dst, src],
+                       capture_output=True, check=True)
+        with open(dst, 'rb') as f:
+            mpy = f.read()
+        if mpy[:1] != b'M' or mpy[1] != version & 0xff:
+            return None
+        if report is not None:
+            source_us, mpy_us = (
+                import_time(micropython, os.path.join(temp_dir, dn),
+                            module)
+                for dn in ('py', 'mpy'))
+            if source_us is not None and mpy_us is not None:
+                report.count('import_mpy_us', mpy_us)
+                report.count('import_saved_us', source_us - mpy_us)
+    return mpy
+
+def import_time(micropython, path, module, repeat=5):
+    env = dict(os.environ, MICROPYPATH=path)
+    script = ('import time\nt = time.ticks_us()\n'
+              f'import {module}\n'
+              'print(time.ticks_diff(time.ticks_us(), t))\n')
+    samples = []
+    for _ in range(repeat):
+        try:
+            proc = subprocess.run([micropython, '-c', script], env=env,
+                                  capture_output=True, check=True)
+            samples.append(int(proc.stdout))
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            return None
+    return min(samples)
+
+def compress_archive(archive, f, compressor):
+    proc = subprocess.Popen(compressor, stdin=subprocess.PIPE,
+           stdout=f, stderr=subprocess.DEVNULL)
+    try:
+        size = archive.write(proc.stdin)
+    finally:
+        proc.stdin.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, compressor)
+    return size
+
+def build_kernels(output, releases, **options):
+    static = os.path.abspath(os.path.join(
+             os.path.dirname(__file__), 'assets'))
+    dependency = collect_dependencies(static, modules=False)
+    userspace = stage_userspace(static, dependency)
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(
+         min(len(releases), os.cpu_count())) as executor:
+        futures = dict((executor.submit(build_kernel, release,
+                        output.replace('{release}', release),
+                        resolver=dependency.resolver,
+                        userspace=userspace, **options), release)
+                       for release in releases)
+        reports = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                report = future.result()
+            except (OSError, LookupError, ValueError,
+                    subprocess.CalledProcessError) as e:
+                failures += 1
+                print (f'* {futures[future]}: {e}', file=sys.stderr)
+            else:
+                print (f'* {futures[future]}: {report.output}')
+                reports.append(report)
+    return failures, sorted(reports, key=lambda report: report.release)
+
+def build_kernel(release, output, **options):
+    set_kernel(release)
+    return build(output, **options)
+
+def benchmark(compressors, module_mode='decompress', hostonly=False):
+    static = os.path.abspath(os.path.join(
+             os.path.dirname(__file__), 'assets'))
+    check_module_mode(module_mode)
+    dependency = collect_dependencies(static, hostonly)
     temp_dir_holder = smart_temporary_directory()
     temp_dir = next(temp_dir_holder).rstrip('/')
+    archive = stage(static, dependency, temp_dir, None, module_mode)
+    stage_overlay(static, archive)
+    buffer = io.BytesIO()
+    archive.write(buffer)
+    data = buffer.getvalue()
+    print (f'{"compressor":<12}{"build":>10}{"size":>14}{"ratio":>8}'
+           f'{"unpack":>12}{"throughput":>16}')
+    print (f'{"cpio":<12}{"":>10}{format_size(len(data)):>14}')
+    for spec in compressors:
+        compressor, decompressor = get_compressor(spec)
+        begin = time.perf_counter()
+        compressed = subprocess.run(compressor, input=data,
+                     capture_output=True, check=True).stdout
+        build_time = time.perf_counter() - begin
+        unpack_time = decompress_time(spec.split(':', 1)[0], compressed,
+                                      decompressor)
+        throughput = format_size(int(len(data) / unpack_time))
+        print (f'{spec:<12}{build_time:>9.2f}s'
+               f'{format_size(len(compressed)):>14}'
+               f'{len(data) / len(compressed):>7.2f}x'
+               f'{unpack_time:>11.3f}s{throughput + "/s":>16}')
+
+def decompress_time(name, compressed, decompressor):
+    decompress = {'xz': lzma.decompress, 'gzip': gzip.decompress}.get(name)
+    if 'zstd' == name:
+        try:
+            import zstandard
+        except ImportError:
+            pass
+        else:
+            decompress = zstandard.ZstdDecompressor().decompressobj() \
+                         .decompress
+    if decompress is not None:
+        begin = time.perf_counter()
+        decompress(compressed)
+        return time.perf_counter() - begin
+    # no decoder in-process, take the pipe and process start off with cat
+    times = []
+    for cmd in (decompressor, ['cat']):
+        begin = time.perf_counter()
+        subprocess.run(cmd, input=compressed, stdout=subprocess.DEVNULL,
+                       check=True)
+        times.append(time.perf_counter() - begin)
+    return max(times[0] - times[1], 1e-6)
+
+def collect_dependencies(static, hostonly=False, resolver=None,
+                         modules=True):
+    dependency = Dependency(resolver, modules)
+    dependency.collect(os.path.join(static, 'micropython'), False)
+    for driver in DRIVERS:
+        if modules or not driver.startswith('/lib/modules/'):
+            dependency.collect(driver)
+    if hostonly:
+        generic = set(dependency.including_deps)
+        names = dependency.match_modaliases(host_modaliases())
+        dependency.restrict_kernel_objects(names, HOSTONLY_MODULES)
+        print_hostonly_report(generic, dependency.including_deps)
+    return dependency
+
+def stage(static, dependency, temp_dir, cache=None,
+          module_mode='decompress', userspace=None, report=None):
+    if report is None:
+        report = BuildReport()
+    with report.phase('userspace'):
+        if userspace is None:
+            archive = stage_userspace(static, dependency)
+        else:
+            archive = userspace.copy()
+    with report.phase('modules'):
+        stage_modules(dependency, temp_dir, cache, module_mode, report)
+    with report.phase('index'):
+        index_modules(dependency, temp_dir, module_mode)
+    # mdev loads hotplugged drivers by alias, keep network drivers out
+    # like coldplug does, blacklist only applies to alias lookups
+    archive.add_data('etc/modprobe.d/hotplug-net.conf', b''.join(
+        f'blacklist {module_name(fn)}\n'.encode()
+        for fn in sorted(dependency.including_deps)
+        if fn.startswith(f'/{LMK}/') and is_module(fn)
+        and '/drivers/net/' in fn))
+    archive.add_tree(LMK, os.path.join(temp_dir, LMK))
+    return archive
+
+def stage_modules(dependency, temp_dir, cache=None,
+                  module_mode='decompress', report=None):
+    modules = []
+    for src in sorted(dependency.including_deps):
+        if not src.startswith(f'/{LMK}/') or not os.path.exists(src):
+            continue
+        dst = f'{temp_dir}/{src.lstrip("/")}'
+        if not os.path.exists(dst):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if cache is not None:
+                modules.append((cache.stage, src, dst))
+            elif is_module(src):
+                modules.append((stage_module, src,
+                                staged_module_name(dst, module_mode)))
+            else:
+                shutil.copy(src, dst)
+    with concurrent.futures.ThreadPoolExecutor(os.cpu_count()) as executor:
+        futures = [executor.submit(func, src, dst, module_mode)
+                   for func, src, dst in modules]
+        for future in futures:
+            future.result()
+    if report is not None:
+        report.count('modules', len(modules))
+        report.count('module_bytes', sum(os.path.getsize(src)
+                                         for _, src, _ in modules))
+
+def index_modules(dependency, temp_dir, module_mode='decompress'):
+    base = dependency.modules.base
+    lmk_len = len(f'/{LMK}/')
+    keys = [fn[lmk_len:] for fn in dependency.including_deps
+            if fn.startswith(f'/{LMK}/') and is_module(fn)]
+    order = {}
+    for row in read_rows(f'{base}/modules.order'):
+        order.setdefault(module_name(row.strip()), len(order))
+    keys.sort(key=lambda key: (order.get(module_name(key), len(order)),
+                               key))
+    names = dict((module_name(key), i) for i, key in enumerate(keys))
+    staged = dict((key, staged_module_name(key, module_mode))
+                  for key in keys)
+    rows, entries = [], []
+    for i, key in enumerate(keys):
+        deps = [staged[dep] for dep
+                in dependency.modules.modules_dep.get(key, [])
+                if dep in staged]
+        row = f'{staged[key]}: {" ".join(deps)}'.rstrip()
+        rows.append(f'{row}\n')
+        entries.append((module_name(key), row, i))
+    dst = os.path.join(temp_dir, LMK)
+    write_rows(f'{dst}/modules.order',
+               [f'{staged[key]}\n' for key in keys])
+    write_rows(f'{dst}/modules.dep', rows)
+    write_kmod_index(f'{dst}/modules.dep.bin', entries)
+    for fn in ('modules.alias', 'modules.symbols'):
+        rows, entries = [], []
+        for row in read_rows(f'{base}/{fn}'):
+            seq = row.split()
+            if 3 == len(seq) and 'alias' == seq[0] \
+               and module_name(seq[2]) in names:
+                rows.append(row)
+                entries.append((seq[1], seq[2],
+                                names[module_name(seq[2])]))
+        write_rows(f'{dst}/{fn}', rows)
+        write_kmod_index(f'{dst}/{fn}.bin', entries)
+    for fn, field in (('modules.softdep', 1), ('modules.weakdep', 1),
+                      ('modules.devname', 0)):
+        if os.path.exists(f'{base}/{fn}'):
+            write_rows(f'{dst}/{fn}',
+                       [row for row in read_rows(f'{base}/{fn}')
+                        if not row.startswith('#')
+                        and len(row.split()) > field
+                        and module_name(row.split()[field]) in names])
+
+def read_rows(path):
+    try:
+        with open(path) as f:
+            return f.readlines()
+    except FileNotFoundError:
+        return []
+
+def write_rows(path, rows):
+    with open(path, 'w') as f:
+        f.writelines(rows)
+
+def stage_userspace(static, dependency):
+    archive = Archive()
     for dn in ('bin dev etc/modprobe.d mnt proc root run sys tmp '
                'var/log usr/lib').split():
-        os.makedirs(f'{temp_dir}/{dn}', exist_ok=True)
-    os.symlink('bin', f'{temp_dir}/sbin')
-    for fn in ('blkid busybox eject micropython').split():
-        dst = f'{temp_dir}/bin/{fn}'
-        shutil.copy(os.path.join(static, fn), dst)
-        os.chmod(dst, os.stat(dst).st_mode | 0o755)
-    with open(f'{temp_dir}/etc/modprobe.d/local-loop.conf', 'w') as f:
-        f.write('options loop max_loop=32')
+        archive.add_directory(dn)
+    archive.add_symlink('sbin', 'bin')
+    for fn in base_assets(static):
+        archive.add_file(f'bin/{fn}', os.path.join(static, fn),
+                         mode=os.stat(os.path.join(static, fn)).st_mode
+                              | 0o755)
     begin = False
-    for row in run(f'{temp_dir}/bin/busybox').stdout.split(b'\n'):
+    for row in run(os.path.join(static, 'busybox')).stdout.split(b'\n'):
         if begin:
             row = row.strip()
             if b'' == row:
@@ -36,8 +364,8 @@ def build(output):
             for func in row.split(b','):
                 func = func.decode().strip()
                 if func:
-                    if not os.path.exists(f'{temp_dir}/bin/{func}'):
-                        os.symlink('busybox', f'{temp_dir}/bin/{func}')
+                    if f'bin/{func}' not in archive:
+                        archive.add_symlink(f'bin/{func}', 'busybox')
         elif b'currently defined functions:' == row.strip().lower():
             begin = True
     for mode, major, minor, fn in \
@@ -48,143 +376,244 @@ def build(output):
          (stat.S_IFCHR | 0o620, 4, 2, 'dev/tty2'),
          (stat.S_IFCHR | 0o620, 4, 3, 'dev/tty3'),
          (stat.S_IFCHR | 0o620, 4, 4, 'dev/tty4')]:
-        os.mknod(f'{temp_dir}/{fn}', mode, os.makedev(major, minor))
-    dependency = Dependency()
-    dependency.collect(os.path.join(static, 'micropython'), False)
-    for driver in DRIVERS:
-        dependency.collect(driver)
-    including_deps = sorted(dependency.including_deps)
-    for src in including_deps:
-        dst = f'{temp_dir}/{src.lstrip("/")}'
-        if os.path.exists(src) and not os.path.exists(dst):
-            os.makedirs(os.path.dirname(dst), exist_ok=True)
-            shutil.copy(src, dst)
+        archive.add_node(fn, mode, major, minor)
+    ld_linux = get_ld_linux()
+    for src in sorted(dependency.including_deps):
+        if src.startswith(f'/{LMK}/') or not os.path.exists(src):
+            continue
+        if src.lstrip('/') not in archive:
+            if src == ld_linux:
+                archive.add_file(src, src,
+                                 mode=os.stat(src).st_mode | 0o755)
+            else:
+                archive.add_file(src, src)
     for src, dst in dependency.symbolic_links:
-        dst = f'{temp_dir}/{dst.lstrip("/")}'
-        if not os.path.exists(dst):
-            os.makedirs(os.path.dirname(dst), exist_ok=True)
-            os.symlink(src, dst)
-    for pattern, args in [('*.ko.gz', ['/usr/bin/gunzip']),
-                          ('*.ko.xz', ['/usr/bin/xz', '-d'])]:
-        for fn in glob.glob(f'{temp_dir}/**/{pattern}', recursive=True):
-            subprocess.run(args + [fn], check=True)
-    moduleorder = []
-    with subprocess.Popen(['/bin/find', '-name', '*.ko'],
-                          cwd=os.path.join(temp_dir, LMK),
-                          stdout=subprocess.PIPE,
-                          stderr=subprocess.DEVNULL) as proc:
-        stdout, _ = proc.communicate()
-        for _mod in stdout.split(b'\n'):
-            _mod = _mod.strip()
-            if b'' == _mod:
-                continue
-            mod = _mod.decode()
-            if mod.startswith('./'):
-                moduleorder.append(mod[2:])
-            elif mod.startswith('/'):
-                moduleorder.append(mod[1:])
-    with open(os.path.join(temp_dir, LMK, 'modules.order'), 'w') as f:
-        f.write('\n'.join(reversed(moduleorder)))
-        f.write('\n')
-    run(f'/sbin/depmod -b {temp_dir} {os.uname().release}')
-    with open(f'{temp_dir}/etc/passwd', 'w') as f:
-        f.write('root::0:0::/root:/bin/sh')
-    for fn in ['etc/fstab', 'etc/mtab']:
-        with open(f'{temp_dir}/{fn}', 'w') as f:
-            pass
-    pattern = os.path.join(dst, '**/__pycache__')
-    for dn in glob.glob(pattern, recursive=True):
-        if os.path.isdir(dn):
-            shutil.rmtree(dn)
+        if dst.lstrip('/') not in archive:
+            archive.add_symlink(dst, src)
+    return archive
+
+def stage_overlay(static, archive, report=None):
     ld_linux = get_ld_linux()
-    with open(os.path.join(static, 'init.in')) as file_in:
-        with open(f'{temp_dir}/init', 'w') as file_out:
-            file_out.write(file_in.read().replace('{run_bootstrap_py}',
-                     f'{ld_linux} /bin/micropython /bin/bootstrap.py '
-                     f'{ld_linux}'))
-    shutil.copy(os.path.join(static, 'shutdown'), f'{temp_dir}/shutdown')
-    os.makedirs(f'{temp_dir}/usr/lib/micropython', exist_ok=True)
-    shutil.copy(
-        os.path.abspath(os.path.join(
-        os.path.dirname(__file__), 'bootstraplib.py')),
-        f'{temp_dir}/usr/lib/micropython/bootstraplib.py'
-    )
-    with open(f'{temp_dir}/bin/bootstrap.py', 'w') as f:
-        f.write('#!/bin/micropython\n\nimport bootstraplib\n\n'
-                'if "__main__" == __name__:\n    bootstraplib.main()\n')
-    os.makedirs(f'{temp_dir}/usr/share/fresh_os', exist_ok=True)
-    shutil.copy(
+    archive.add_data('etc/modprobe.d/local-loop.conf',
+                     b'options loop max_loop=32')
+    archive.add_data('etc/mdev.conf',
+                     b'$MODALIAS=.* 0:0 0660 @modprobe -q "$MODALIAS"\n')
+    archive.add_data('etc/passwd', b'root::0:0::/root:/bin/sh')
+    for fn in ['etc/fstab', 'etc/mtab']:
+        archive.add_data(fn, b'')
+    with open(os.path.join(static, 'init.in')) as f:
+        archive.add_data('init', f.read().replace('{run_bootstrap_py}',
+                         f'{ld_linux} /bin/micropython /bin/bootstrap.py '
+                         f'{ld_linux}').encode(), mode=0o755)
+    archive.add_file('shutdown', os.path.join(static, 'shutdown'),
+                     mode=0o755)
+    bootstraplib_py = os.path.abspath(os.path.join(
+                      os.path.dirname(__file__), 'bootstraplib.py'))
+    archive.add_file('usr/lib/micropython/bootstraplib.py',
+                     bootstraplib_py)
+    mpy = compile_mpy(static, bootstraplib_py, report)
+    if mpy is not None:
+        with open(bootstraplib_py, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        archive.add_data('usr/lib/micropython/mpy/bootstraplib.mpy', mpy)
+        archive.add_data('usr/lib/micropython/mpy/bootstraplib.sha256',
+                         digest.encode())
+    archive.add_data('bin/bootstrap.py', BOOTSTRAP_PY.encode(),
+                     mode=0o755)
+    archive.add_file(
+        'usr/share/fresh_os/savechanges',
         os.path.abspath(os.path.join(
         os.path.dirname(__file__), 'savechanges.py')),
-        f'{temp_dir}/usr/share/fresh_os/savechanges'
+        mode=0o755
     )
-    shutil.copy(
+    archive.add_file(
+        'usr/share/fresh_os/initramfs_create.py',
         os.path.abspath(__file__),
-        f'{temp_dir}/usr/share/fresh_os/initramfs_create.py'
+        mode=0o755
     )
-    for fn in ('dir2sb initramfs_pack init.in initramfs_unpack '
+    for fn in ('dir2sb initramfs_pack initramfs_unpack '
                'rmsbdir sb sb2dir').split():
-        shutil.copy(os.path.join(static, fn),
-                    f'{temp_dir}/usr/share/fresh_os/{fn}')
-    for dst in [ld_linux,
-                f'{temp_dir}/init',
-                f'{temp_dir}/shutdown',
-                f'{temp_dir}/bin/bootstrap.py',
-                f'{temp_dir}/usr/share/fresh_os/savechanges',
-                f'{temp_dir}/usr/share/fresh_os/dir2sb',
-                f'{temp_dir}/usr/share/fresh_os/initramfs_create.py',
-                f'{temp_dir}/usr/share/fresh_os/initramfs_pack',
-                f'{temp_dir}/usr/share/fresh_os/initramfs_unpack',
-                f'{temp_dir}/usr/share/fresh_os/rmsbdir',
-                f'{temp_dir}/usr/share/fresh_os/sb',
-                f'{temp_dir}/usr/share/fresh_os/sb2dir']:
-        os.chmod(dst, os.stat(dst).st_mode | 0o755)
-    with open(output, 'wb') as f:
-        find_proc = subprocess.Popen(['/bin/find', '.', '-print'],
-                    cwd=temp_dir,
-                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-        args = ['/usr/bin/cpio', '-o', '-H', 'newc']
-        cpio_proc = subprocess.Popen(args,
-                    cwd=temp_dir, stdin=find_proc.stdout,
-                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-        args = ['/usr/bin/xz', '-T0', '-f', '--extreme', '--check=crc32']
-        xz_proc = subprocess.Popen(args, stdin=cpio_proc.stdout,
-                  stdout=f, stderr=subprocess.DEVNULL)
-        find_proc.stdout.close()
-        cpio_proc.stdout.close()
-        xz_proc.communicate()
+        archive.add_file(f'usr/share/fresh_os/{fn}',
+                         os.path.join(static, fn), mode=0o755)
+    archive.add_file('usr/share/fresh_os/init.in',
+                     os.path.join(static, 'init.in'))
+    return archive
+
+class BuildReport:
+
+    def __init__(self):
+        self.release = RELEASE
+        self.output = None
+        self.phases = []
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall, cpu = time.perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - wall,
+                                cpu_time() - cpu))
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        return {'release': self.release,
+                 'output': self.output,
+                 'phases': [{'name': name, 'wall': wall, 'cpu': cpu}
+                            for name, wall, cpu in self.phases],
+               'counters': self.counters}
+
+    def print_table(self, file=sys.stdout):
+        print (f'{self.release}: {self.output}', file=file)
+        print (f'{"phase":<12}{"wall":>10}{"cpu":>10}', file=file)
+        for name, wall, cpu in self.phases:
+            print (f'{name:<12}{wall:>9.2f}s{cpu:>9.2f}s', file=file)
+        print (f'{"total":<12}'
+               f'{sum(wall for _, wall, _ in self.phases):>9.2f}s'
+               f'{sum(cpu for _, _, cpu in self.phases):>9.2f}s',
+               file=file)
+        for name, value in self.counters.items():
+            if name.endswith('_bytes'):
+                value = format_size(value)
+            print (f'{name:<20}{value:>20}', file=file)
+
+class Archive:
+
+    def __init__(self, mtime=None):
+        if mtime is None:
+            mtime = int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+        self.mtime = mtime
+        self.entries = {'.': (stat.S_IFDIR | 0o755, 0, None, None)}
+
+    def copy(self):
+        archive = Archive(self.mtime)
+        archive.entries = dict(self.entries)
+        return archive
+
+    def __contains__(self, dst):
+        return dst.strip('/') in self.entries
+
+    def add_directory(self, dst, mode=0o755):
+        dst = dst.strip('/')
+        if dst and dst not in self.entries:
+            self.add_directory(os.path.dirname(dst))
+            self.entries[dst] = (stat.S_IFDIR | mode, 0, None, None)
+
+    def add_file(self, dst, src, mode=None):
+        dst = dst.strip('/')
+        self.add_directory(os.path.dirname(dst))
+        st = os.stat(src)
+        if mode is None:
+            mode = st.st_mode
+        self.entries[dst] = (stat.S_IFREG | stat.S_IMODE(mode), 0,
+                             src, (st.st_dev, st.st_ino))
+
+    def add_data(self, dst, data, mode=0o644):
+        dst = dst.strip('/')
+        self.add_directory(os.path.dirname(dst))
+        self.entries[dst] = (stat.S_IFREG | mode, 0, data, None)
+
+    def add_symlink(self, dst, target):
+        dst = dst.strip('/')
+        self.add_directory(os.path.dirname(dst))
+        self.entries[dst] = (stat.S_IFLNK | 0o777, 0,
+                             os.fsencode(target), None)
+
+    def add_node(self, dst, mode, major, minor):
+        dst = dst.strip('/')
+        self.add_directory(os.path.dirname(dst))
+        self.entries[dst] = (mode, os.makedev(major, minor), None, None)
+
+    def add_tree(self, dst, src):
+        dst = dst.strip('/')
+        self.add_directory(dst)
+        for root, dirs, files in os.walk(src):
+            dirs[:] = [dn for dn in dirs if '__pycache__' != dn]
+            base = os.path.normpath(
+                   os.path.join(dst, os.path.relpath(root, src)))
+            for fn in dirs + files:
+                path = os.path.join(root, fn)
+                st = os.lstat(path)
+                if stat.S_ISDIR(st.st_mode):
+                    self.add_directory(f'{base}/{fn}',
+                                       stat.S_IMODE(st.st_mode))
+                elif stat.S_ISLNK(st.st_mode):
+                    self.add_symlink(f'{base}/{fn}', os.readlink(path))
+                elif stat.S_ISREG(st.st_mode):
+                    self.add_file(f'{base}/{fn}', path)
+
+    def write(self, f):
+        names = sorted(self.entries)
+        links = {}
+        for name in names:
+            inode = self.entries[name][3]
+            if inode is not None:
+                links.setdefault(inode, []).append(name)
+        inodes, written = {}, 0
+        for ino, name in enumerate(names, 1):
+            mode, rdev, data, inode = self.entries[name]
+            if inode is None:
+                nlink = 2 if stat.S_ISDIR(mode) else 1
+            else:
+                ino = inodes.setdefault(inode, ino)
+                nlink = len(links[inode])
+            if isinstance(data, str):
+                if nlink > 1 and links[inode][-1] != name:
+                    size = 0
+                else:
+                    size = os.stat(data).st_size
+            elif data is None:
+                size = 0
+            else:
+                size = len(data)
+            written += Archive.write_header(f, name, ino, mode, nlink,
+                                            self.mtime, size, rdev)
+            if 0 == size:
+                continue
+            if isinstance(data, str):
+                with open(data, 'rb') as f_in:
+                    shutil.copyfileobj(f_in, f, 1 << 20)
+            else:
+                f.write(data)
+            f.write(b'\0' * (-size % 4))
+            written += size + -size % 4
+        written += Archive.write_header(f, 'TRAILER!!!',
+                                        0, 0, 1, 0, 0, 0)
+        f.write(b'\0' * (-written % 512))
+        return written + (-written % 512)
+
+    @staticmethod
+    def write_header(f, name, ino, mode, nlink, mtime, size, rdev):
+        _name = os.fsencode(name) + b'\0'
+        fields = (ino, mode, 0, 0, nlink, mtime, size, 0, 0,
+                  os.major(rdev), os.minor(rdev), len(_name), 0)
+        header = b'070701' + b''.join(b'%08X' % v for v in fields)
+        padding = b'\0' * (-(len(header) + len(_name)) % 4)
+        f.write(header + _name + padding)
+        return len(header) + len(_name) + len(padding)
 
 class Dependency:
 
-    regex_ldd_dep = re.compile(rb'^\s*'
-                    rb'(?:((?:\\.|(?<!=)>|[^>\s])+)\s*=>\s*)?'
-                    rb'((?:\\.|[^\s(])+)'
-                    rb'(?:\s*\([^)]*\)|\s+.*)'       rb'\s*$')
     regex_so_ext = re.compile(r'.*(\.so(\.\d+)*)$')
-    regex_modules_dep_row = re.compile(
-                            r'^\s*((?:\\.|[^:])+)\s*:\s*(.*)\s*$')
-    regex_modules_dep_dep = re.compile(r'(?:^|(?<=\s))(?:\\.|[^\\\s])+')
 
-    def __init__(self):
+    def __init__(self, resolver=None, modules=True):
         self.including_deps = set()
         self.symbolic_links = set()
-        self.modules_dep = {}
-        with open(f'/{LMK}/modules.dep') as f:
-            for row in f.readlines():
-                match = Dependency.regex_modules_dep_row.match(row)
-                if match:
-                    key, deps = match.groups()
-                    self.modules_dep[key] = \
-                         Dependency.regex_modules_dep_dep.findall(deps)
+        self.resolver = LibraryResolver() if resolver is None else resolver
+        self.modules = ModuleGraph(f'/{LMK}') if modules else None
 
     def collect(self, mod, include_source=True):
         _mod = os.path.abspath(mod)
         if os.path.isdir(_mod):
-            pattern = os.path.join(_mod, '**/*.ko')
+            pattern = os.path.join(_mod, '**/*.ko*')
             for kernel_object in glob.glob(pattern, recursive=True):
-                self.include_kernel_object(kernel_object)
+                if is_module(kernel_object):
+                    self.include_kernel_object(kernel_object)
         elif os.path.isfile(_mod):
-            if _mod.endswith('.ko'):
+            if is_module(_mod):
                 self.include_kernel_object(_mod)
             else:
                 self.include_shared_object(_mod)
@@ -195,33 +624,38 @@ class Dependency:
                 self.include_file(_mod)
 
     def include_kernel_object(self, kernel_object):
-        if kernel_object.startswith(f'/{LMK}/'):
+        if kernel_object.startswith(f'/{LMK}/') \
+           and kernel_object not in self.including_deps:
             lmk_len = len(f'/{LMK}/')
-            key = kernel_object[lmk_len:]
-            if key in self.modules_dep:
-                for dep in self.modules_dep[key]:
-                    self.include_kernel_object(f'/{LMK}/{dep}')
+            for key in self.modules.closure([kernel_object[lmk_len:]]):
+                self.including_deps.add(f'/{LMK}/{key}')
             self.including_deps.add(kernel_object)
 
+    def match_modaliases(self, modaliases):
+        names = set()
+        for modalias in modaliases:
+            names.update(self.modules.match_alias(modalias))
+        return names
+
+    def restrict_kernel_objects(self, names, patterns=()):
+        kernel_objects = [fn for fn in self.including_deps
+                          if fn.startswith(f'/{LMK}/') and is_module(fn)]
+        self.including_deps.difference_update(kernel_objects)
+        for kernel_object in kernel_objects:
+            name = module_name(kernel_object)
+            if name in names or any(fnmatch.fnmatchcase(name, pattern)
+                                    for pattern in patterns):
+                self.include_kernel_object(kernel_object)
+
     def include_shared_object(self, shared_object):
-        proc = subprocess.run(['/usr/bin/ldd', shared_object],
-                              capture_output=True)
-        if 0 == proc.returncode:
-            for row in proc.stdout.split(b'\n'):
-                match = Dependency.regex_ldd_dep.match(row)
-                if match is None:
-                    continue
-                _obj, _loc = match.groups()
-                if not _loc.startswith(b'/'):
-                    continue
-                loc = os.path.realpath(_loc.decode())
-                if _obj is not None:
-                    obj = _obj.decode()
-                    src = os.path.basename(loc)
-                    if src != obj:
-                        dst = os.path.join(os.path.dirname(loc), obj)
-                        self.symbolic_links.add((src, dst))
-                self.including_deps.add(loc)
+        for obj, _loc in self.resolver.dependencies(shared_object):
+            loc = os.path.realpath(_loc)
+            if obj is not None:
+                src = os.path.basename(loc)
+                if src != obj:
+                    dst = os.path.join(os.path.dirname(loc), obj)
+                    self.symbolic_links.add((src, dst))
+            self.including_deps.add(loc)
 
     def include_file(self, mod):
         if mod.startswith(f'/{LMK}/'):
@@ -237,6 +671,627 @@ class Dependency:
                     self.symbolic_links.add((loc, mod))
                 self.including_deps.add(loc)
 
+class ModuleGraph:
+
+    regex_modules_dep_row = re.compile(
+                            r'^\s*((?:\\.|[^:])+)\s*:\s*(.*)\s*$')
+    regex_modules_dep_dep = re.compile(r'(?:^|(?<=\s))(?:\\.|[^\\\s])+')
+
+    def __init__(self, base):
+        self.base = base
+        self.modules_dep = {}
+        try:
+            rows = [f'{value}\n' for _, value in
+                    read_kmod_index(f'{base}/modules.dep.bin')]
+        except (OSError, ValueError, struct.error):
+            with open(f'{base}/modules.dep') as f:
+                rows = f.readlines()
+        for row in rows:
+            match = ModuleGraph.regex_modules_dep_row.match(row)
+            if match:
+                key, deps = match.groups()
+                self.modules_dep[key] = \
+                     ModuleGraph.regex_modules_dep_dep.findall(deps)
+        self.names = dict((module_name(key), key)
+                          for key in self.modules_dep)
+        self.softdeps = {}
+        try:
+            with open(f'{base}/modules.softdep') as f:
+                rows = f.readlines()
+        except FileNotFoundError:
+            rows = []
+        for row in rows:
+            seq = row.split()
+            if len(seq) > 2 and 'softdep' == seq[0]:
+                deps = [dep for dep in seq[2:]
+                        if dep not in ('pre:', 'post:')]
+                self.softdeps.setdefault(module_name(seq[1]), []) \
+                    .extend(deps)
+        self.aliases = None
+        self.closures = {}
+
+    def load_aliases(self):
+        self.aliases = {}
+        try:
+            with open(f'{self.base}/modules.alias') as f:
+                rows = f.readlines()
+        except FileNotFoundError:
+            rows = []
+        for row in rows:
+            seq = row.split()
+            if 3 == len(seq) and 'alias' == seq[0]:
+                prefix = re.split(r'[:*?\[]', seq[1], 1)[0]
+                self.aliases.setdefault(prefix, []) \
+                    .append((seq[1], module_name(seq[2])))
+
+    def match_alias(self, alias):
+        if self.aliases is None:
+            self.load_aliases()
+        return set(name for pattern, name
+                   in self.aliases.get(alias.split(':', 1)[0], [])
+                   if fnmatch.fnmatchcase(alias, pattern))
+
+    def lookup(self, name):
+        name = module_name(name)
+        if name in self.names:
+            return [self.names[name]]
+        return [self.names[_name] for _name in sorted(self.match_alias(name))
+                if _name in self.names]
+
+    def dependencies(self, key):
+        deps = list(self.modules_dep.get(key, []))
+        for name in self.softdeps.get(module_name(key), []):
+            deps.extend(self.lookup(name))
+        return deps
+
+    def module_closure(self, key):
+        return self.visit_closure(key, {})[0]
+
+    def visit_closure(self, key, visiting):
+        # a closure that reached a module still being visited above it is
+        # missing part of a cycle, it is returned but only cached once the
+        # module that started the cycle is done
+        if key in self.closures:
+            return self.closures[key], None
+        depth = visiting[key] = len(visiting)
+        closure, low = {}, None
+        for dep in self.dependencies(key):
+            if dep in visiting:
+                dep_low = visiting[dep]
+            else:
+                deps, dep_low = self.visit_closure(dep, visiting)
+                closure.update(dict.fromkeys(deps))
+            if dep_low is not None and (low is None or dep_low < low):
+                low = dep_low
+        closure[key] = None
+        del visiting[key]
+        if low is not None and low >= depth:
+            low = None
+        if low is None:
+            self.closures[key] = tuple(closure)
+        return tuple(closure), low
+
+    def closure(self, keys):
+        closure = {}
+        for key in keys:
+            if key not in closure:
+                closure.update(dict.fromkeys(self.module_closure(key)))
+        return list(closure)
+
+class ElfFile:
+
+    PT_LOAD, PT_DYNAMIC, PT_INTERP = 1, 2, 3
+    DT_NEEDED, DT_STRTAB, DT_STRSZ, DT_RPATH, DT_RUNPATH = 1, 5, 10, 15, 29
+
+    def __init__(self, path):
+        self.path = path
+        self.interpreter = None
+        self.needed = []
+        self.rpath = []
+        self.runpath = []
+        with open(path, 'rb') as f:
+            ident = f.read(16)
+            if len(ident) < 16 or ident[:4] != b'\x7fELF':
+                raise ValueError(f'"{path}" is not an ELF file')
+            self.elf_class = ident[4]
+            order = '<' if 1 == ident[5] else '>'
+            if 2 == self.elf_class:
+                ehdr = struct.unpack(order + 'HHIQQQIHHHHHH', f.read(48))
+                phdr = struct.Struct(order + 'IIQQQQQQ')
+                dyn = struct.Struct(order + 'qQ')
+            else:
+                ehdr = struct.unpack(order + 'HHIIIIIHHHHHH', f.read(36))
+                phdr = struct.Struct(order + 'IIIIIIII')
+                dyn = struct.Struct(order + 'iI')
+            self.machine = ehdr[1]
+            phoff, phentsize, phnum = ehdr[4], ehdr[8], ehdr[9]
+            segments = []
+            for i in range(phnum):
+                f.seek(phoff + i * phentsize)
+                fields = phdr.unpack(f.read(phdr.size))
+                if 2 == self.elf_class:
+                    p_type, _, offset, vaddr, _, filesz = fields[0:6]
+                else:
+                    p_type, offset, vaddr, _, filesz = fields[0:5]
+                segments.append((p_type, offset, vaddr, filesz))
+            entries = []
+            for p_type, offset, vaddr, filesz in segments:
+                if ElfFile.PT_INTERP == p_type:
+                    f.seek(offset)
+                    self.interpreter = os.fsdecode(
+                                       f.read(filesz).split(b'\0')[0])
+                elif ElfFile.PT_DYNAMIC == p_type:
+                    f.seek(offset)
+                    data = f.read(filesz)
+                    for tag, val in dyn.iter_unpack(
+                                    data[:len(data) - len(data) % dyn.size]):
+                        if 0 == tag:
+                            break
+                        entries.append((tag, val))
+            tags = dict(entries)
+            if ElfFile.DT_STRTAB not in tags:
+                return
+            for p_type, offset, vaddr, filesz in segments:
+                if ElfFile.PT_LOAD == p_type \
+                   and vaddr <= tags[ElfFile.DT_STRTAB] < vaddr + filesz:
+                    f.seek(tags[ElfFile.DT_STRTAB] - vaddr + offset)
+                    strtab = f.read(tags.get(ElfFile.DT_STRSZ, 0))
+                    break
+            else:
+                return
+        def string(val):
+            return os.fsdecode(strtab[val:strtab.index(b'\0', val)])
+        for tag, val in entries:
+            if ElfFile.DT_NEEDED == tag:
+                self.needed.append(string(val))
+            elif ElfFile.DT_RPATH == tag:
+                self.rpath.extend(string(val).split(':'))
+            elif ElfFile.DT_RUNPATH == tag:
+                self.runpath.extend(string(val).split(':'))
+
+class LibraryResolver:
+
+    default_dirs = {1: ['/lib', '/usr/lib', '/lib32', '/usr/lib32'],
+                    2: ['/lib64', '/usr/lib64', '/lib', '/usr/lib']}
+
+    def __init__(self, ld_so_cache='/etc/ld.so.cache'):
+        self.elf_files = {}
+        self.sonames = {}
+        self.closures = {}
+        self.ld_so_cache = LibraryResolver.read_ld_so_cache(ld_so_cache)
+
+    def elf_file(self, path):
+        loc = os.path.realpath(path)
+        if loc not in self.elf_files:
+            try:
+                self.elf_files[loc] = ElfFile(loc)
+            except (OSError, ValueError, struct.error):
+                self.elf_files[loc] = None
+        return self.elf_files[loc]
+
+    def resolve(self, soname, elf):
+        if '/' in soname:
+            return soname if os.path.isfile(soname) else None
+        origin = os.path.dirname(os.path.realpath(elf.path))
+        lib = 'lib64' if 2 == elf.elf_class else 'lib'
+        search = [dn.replace('${ORIGIN}', origin)
+                    .replace('$ORIGIN', origin)
+                    .replace('${LIB}', lib).replace('$LIB', lib)
+                  for dn in (elf.runpath or elf.rpath)]
+        key = (soname, elf.elf_class, elf.machine, tuple(search))
+        if key not in self.sonames:
+            candidates = [os.path.join(dn, soname) for dn in search]
+            candidates += self.ld_so_cache.get(soname, [])
+            candidates += [os.path.join(dn, soname) for dn in
+                           LibraryResolver.default_dirs.get(
+                           elf.elf_class, [])]
+            for candidate in candidates:
+                dep = self.elf_file(candidate) \
+                      if os.path.isfile(candidate) else None
+                if dep is not None and dep.elf_class == elf.elf_class \
+                   and dep.machine == elf.machine:
+                    self.sonames[key] = candidate
+                    break
+            else:
+                self.sonames[key] = None
+        return self.sonames[key]
+
+    def dependencies(self, path):
+        loc = os.path.realpath(path)
+        if loc in self.closures:
+            return self.closures[loc]
+        elf = self.elf_file(loc)
+        result, visited = [], set()
+        if elf is not None and (elf.needed or elf.interpreter):
+            if elf.interpreter is not None \
+               and os.path.exists(elf.interpreter):
+                result.append((None, elf.interpreter))
+                visited.add(os.path.realpath(elf.interpreter))
+            pending = [elf]
+            while pending:
+                obj = pending.pop(0)
+                for soname in obj.needed:
+                    dep_loc = self.resolve(soname, obj)
+                    if dep_loc is None \
+                       or os.path.realpath(dep_loc) in visited:
+                        continue
+                    visited.add(os.path.realpath(dep_loc))
+                    result.append((soname, dep_loc))
+                    dep = self.elf_file(dep_loc)
+                    if dep is not None:
+                        pending.append(dep)
+        self.closures[loc] = result
+        return result
+
+    @staticmethod
+    def read_ld_so_cache(path):
+        entries = {}
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return entries
+        base = data.find(b'glibc-ld.so.cache1.1')
+        if base < 0:
+            return entries
+        def string(offset):
+            return os.fsdecode(data[base+offset:data.index(b'\0',
+                               base+offset)])
+        nlibs, = struct.unpack_from('=I', data, base + 20)
+        for i in range(nlibs):
+            _, key, value = struct.unpack_from('=iII', data,
+                                                base + 48 + 24 * i)
+            entries.setdefault(string(key), []).append(string(value))
+        return entries
+
+class BuildCache:
+
+    version = 1
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.objects = os.path.join(self.cache_dir, 'objects')
+        self.images = os.path.join(self.cache_dir, 'images')
+        self.segments = os.path.join(self.cache_dir, 'segments')
+        self.temp_dir = os.path.join(self.cache_dir, 'tmp')
+        self.max_size = max_size
+        for dn in (self.objects, self.images, self.segments,
+                   self.temp_dir):
+            os.makedirs(dn, exist_ok=True)
+
+    def fingerprint(self, static, dependency, *options, overlay=True):
+        digest = hashlib.sha256()
+        digest.update(f'{BuildCache.version}\0{RELEASE}'
+                      f'\0{get_ld_linux()}\0'.encode())
+        # the archive stamps every entry with this mtime
+        digest.update(f'{os.environ.get("SOURCE_DATE_EPOCH", "0")}\0'
+                      .encode())
+        for option in options:
+            digest.update(f'{option}\0'.encode())
+        for driver in DRIVERS:
+            digest.update(f'{driver}\0'.encode())
+        for src in sorted(dependency.including_deps):
+            try:
+                st = os.stat(src)
+            except FileNotFoundError:
+                continue
+            digest.update(f'{src}\0{st.st_size}\0{st.st_mtime_ns}\0'
+                          .encode())
+        for src, dst in sorted(dependency.symbolic_links):
+            digest.update(f'{src}\0{dst}\0'.encode())
+        base = os.path.dirname(os.path.abspath(__file__))
+        if overlay:
+            assets = [os.path.join(static, fn)
+                      for fn in sorted(os.listdir(static))]
+            assets += [os.path.join(base, 'bootstraplib.py'),
+                       os.path.join(base, 'savechanges.py')]
+            mpy_cross = shutil.which('mpy-cross')
+            if mpy_cross is not None:
+                try:
+                    version = run(f'"{mpy_cross}" --version').stdout
+                except (OSError, subprocess.CalledProcessError):
+                    version = b''
+                digest.update(f'{mpy_cross}\0'.encode() + version)
+        else:
+            assets = [os.path.join(static, fn)
+                      for fn in base_assets(static)]
+        for fn in assets + [os.path.abspath(__file__)]:
+            with open(fn, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        return digest.hexdigest()
+
+    def restore_image(self, key, output):
+        image = os.path.join(self.images, f'{key}.img')
+        if not os.path.isfile(image):
+            return False
+        os.utime(image)
+        shutil.copyfile(image, output)
+        return True
+
+    def store_image(self, key, output):
+        image = os.path.join(self.images, f'{key}.img')
+        temp = f'{image}.{os.getpid()}'
+        shutil.copyfile(output, temp)
+        os.replace(temp, image)
+        if self.max_size is not None:
+            self.purge(self.max_size)
+
+    def lookup_segment(self, key):
+        segment = os.path.join(self.segments, f'{key}.cpio')
+        if not os.path.isfile(segment):
+            return None
+        os.utime(segment)
+        return segment
+
+    def store_segment(self, key, archive, compressor):
+        segment = os.path.join(self.segments, f'{key}.cpio')
+        temp = f'{segment}.{os.getpid()}'
+        with open(temp, 'wb') as f:
+            size = compress_archive(archive, f, compressor)
+        os.replace(temp, segment)
+        return segment, size
+
+    def stage(self, src, dst, module_mode='decompress'):
+        if not is_module(src):
+            shutil.copy(src, dst)
+            return
+        dst = staged_module_name(dst, module_mode)
+        st = os.stat(src)
+        key = hashlib.sha256(f'{src}\0{st.st_size}\0{st.st_mtime_ns}'
+                             f'\0{module_mode}\0{os.path.basename(dst)}'
+                             .encode()).hexdigest()
+        obj = os.path.join(self.objects, key[:2], key)
+        if os.path.isfile(obj):
+            os.utime(obj)
+        else:
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            temp = f'{obj}.{os.getpid()}'
+            stage_module(src, temp, module_mode)
+            os.replace(temp, obj)
+        try:
+            os.link(obj, dst)
+        except OSError:
+            shutil.copy(obj, dst)
+
+    def entries(self):
+        entries = []
+        for root, dirs, files in os.walk(self.objects):
+            for fn in files:
+                entries.append(os.path.join(root, fn))
+        for dn in (self.images, self.segments):
+            for fn in os.listdir(dn):
+                entries.append(os.path.join(dn, fn))
+        result = []
+        for path in entries:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            result.append((st.st_mtime, st.st_size, path))
+        return sorted(result)
+
+    def stat(self):
+        objects = images = segments = size = 0
+        for _, st_size, path in self.entries():
+            if path.startswith(self.images + '/'):
+                images += 1
+            elif path.startswith(self.segments + '/'):
+                segments += 1
+            else:
+                objects += 1
+            size += st_size
+        return objects, images, segments, size
+
+    def purge(self, max_size=0):
+        entries = self.entries()
+        total = sum(st_size for _, st_size, _ in entries)
+        removed = 0
+        for _, st_size, path in entries:
+            if total <= max_size:
+                break
+            os.remove(path)
+            total -= st_size
+            removed += st_size
+        return removed
+
+def module_name(path):
+    name = re.sub(r'\.ko(\.gz|\.xz|\.zst)?$', '',
+                  os.path.basename(path))
+    return name.replace('-', '_')
+
+def host_modaliases():
+    modaliases = []
+    for root, dirs, files in os.walk('/sys/devices'):
+        if 'modalias' in files:
+            try:
+                with open(os.path.join(root, 'modalias')) as f:
+                    modalias = f.read().strip()
+            except OSError:
+                continue
+            if modalias:
+                modaliases.append(modalias)
+    with open('/proc/mounts') as f:
+        for row in f.readlines():
+            seq = row.split()
+            if len(seq) > 2:
+                modaliases.append(f'fs-{seq[2].split(".", 1)[0]}')
+    return sorted(set(modaliases))
+
+def print_hostonly_report(generic, hostonly):
+    generic_modules = [fn for fn in generic
+                       if fn.startswith(f'/{LMK}/') and is_module(fn)]
+    hostonly_modules = [fn for fn in hostonly
+                        if fn.startswith(f'/{LMK}/') and is_module(fn)]
+    generic_size = sum(os.path.getsize(fn) for fn in generic_modules)
+    hostonly_size = sum(os.path.getsize(fn) for fn in hostonly_modules)
+    print (f'Host-only: {len(hostonly_modules)} of {len(generic_modules)} '
+           f'modules, {format_size(hostonly_size)} of '
+           f'{format_size(generic_size)} '
+           f'({format_size(generic_size - hostonly_size)} saved)')
+
+def read_kmod_index(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, root = struct.unpack_from('>III', data, 0)
+    if magic != 0xB007F457 or version >> 16 != 2:
+        raise ValueError(f'"{path}" is not a kmod index')
+    nodes = [(root, b'')]
+    while nodes:
+        offset, prefix = nodes.pop()
+        pos = offset & 0x0FFFFFFF
+        if offset & 0x80000000:
+            end = data.index(b'\0', pos)
+            prefix, pos = prefix + data[pos:end], end + 1
+        if offset & 0x20000000:
+            first, last = data[pos], data[pos+1]
+            children = struct.unpack_from(f'>{last-first+1}I', data, pos+2)
+            pos += 2 + 4 * len(children)
+            for i, child in enumerate(children):
+                if child:
+                    nodes.append((child, prefix + bytes([first + i])))
+        if offset & 0x40000000:
+            count, = struct.unpack_from('>I', data, pos)
+            pos += 4
+            for _ in range(count):
+                end = data.index(b'\0', pos + 4)
+                yield prefix.decode(), data[pos+4:end].decode()
+                pos = end + 1
+
+def write_kmod_index(path, entries):
+    root = ({}, [])
+    for key, value, priority in entries:
+        node = root
+        for char in key.encode():
+            node = node[0].setdefault(char, ({}, []))
+        node[1].append((priority, value.encode()))
+    with open(path, 'wb') as f:
+        f.write(struct.pack('>III', 0xB007F457, 0x00020001, 0))
+        offset = write_kmod_node(f, root)
+        f.seek(8)
+        f.write(struct.pack('>I', offset))
+
+def write_kmod_node(f, node):
+    children, values = node
+    prefix = b''
+    while 1 == len(children) and not values:
+        (char, (children, values)), = children.items()
+        prefix += bytes([char])
+    offsets = dict((char, write_kmod_node(f, child))
+                   for char, child in sorted(children.items()))
+    offset = f.tell()
+    if prefix:
+        f.write(prefix + b'\0')
+        offset |= 0x80000000
+    if offsets:
+        first, last = min(offsets), max(offsets)
+        f.write(bytes([first, last]))
+        f.write(struct.pack(f'>{last-first+1}I',
+                            *(offsets.get(char, 0)
+                              for char in range(first, last + 1))))
+        offset |= 0x20000000
+    if values:
+        f.write(struct.pack('>I', len(values)))
+        for priority, value in sorted(values, key=lambda v: v[0]):
+            f.write(struct.pack('>I', priority) + value + b'\0')
+        offset |= 0x40000000
+    return offset
+
+def is_module(path):
+    return re.search(r'\.ko(\.gz|\.xz|\.zst)?$', path) is not None
+
+def base_assets(static):
+    return BASE_ASSETS + [fn for fn in OPTIONAL_ASSETS
+                          if os.path.isfile(os.path.join(static, fn))]
+
+def modprobe_suffixes(static=None):
+    if static is None:
+        static = os.path.abspath(os.path.join(
+                 os.path.dirname(__file__), 'assets'))
+    if static not in MODPROBE_SUFFIXES:
+        modprobe = os.path.join(static, 'modprobe')
+        if os.path.isfile(modprobe):
+            try:
+                features = run(f'"{modprobe}" --version').stdout.split()
+            except (OSError, subprocess.CalledProcessError):
+                features = []
+            suffixes = {'.ko'}
+            for suffix, feature in (('.ko.gz', b'+ZLIB'),
+                                    ('.ko.xz', b'+XZ'),
+                                    ('.ko.zst', b'+ZSTD')):
+                if feature in features:
+                    suffixes.add(suffix)
+        else:
+            # busybox modprobe reads gzip and xz, but not zstd
+            suffixes = {'.ko', '.ko.gz', '.ko.xz'}
+        MODPROBE_SUFFIXES[static] = suffixes
+    return MODPROBE_SUFFIXES[static]
+
+def check_module_mode(module_mode):
+    if 'zstd' != module_mode:
+        return
+    if '.ko.zst' not in modprobe_suffixes():
+        raise ValueError('--modules zstd needs a modprobe that loads '
+                         '.ko.zst files, put a kmod modprobe built with '
+                         'zstd in assets/modprobe')
+    if importlib.util.find_spec('zstandard') is None:
+        raise ValueError('--modules zstd needs the zstandard '
+                         'Python module')
+
+def staged_module_name(path, module_mode='decompress'):
+    base = re.sub(r'\.ko(\.gz|\.xz|\.zst)?$', '.ko', path)
+    if 'keep' == module_mode \
+       and path[len(base)-3:] in modprobe_suffixes():
+        return path
+    return f'{base}.zst' if 'zstd' == module_mode else base
+
+def stage_module(src, dst, module_mode='decompress'):
+    target = staged_module_name(src, module_mode)
+    if target == src:
+        shutil.copy(src, dst)
+        return
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+    if src.endswith('.ko.zst') and zstandard is None:
+        with open(dst, 'wb') as f:
+            subprocess.run(['zstd', '-d', '-q', '-c', src],
+                           stdout=f, check=True)
+    elif src.endswith('.ko.zst'):
+        with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+            zstandard.ZstdDecompressor().copy_stream(f_in, f_out)
+    else:
+        if src.endswith('.ko.xz'):
+            f_in = lzma.open(src)
+        elif src.endswith('.ko.gz'):
+            f_in = gzip.open(src)
+        else:
+            f_in = open(src, 'rb')
+        with f_in, open(dst, 'wb') as f_out:
+            if target.endswith('.zst'):
+                zstandard.ZstdCompressor(level=19).copy_stream(f_in,
+                                                               f_out)
+            else:
+                shutil.copyfileobj(f_in, f_out, 1 << 20)
+    shutil.copymode(src, dst)
+
+def set_kernel(release):
+    global RELEASE, LMK, DRIVERS
+    if not os.path.isdir(f'/lib/modules/{release}'):
+        raise NotADirectoryError(errno.ENOTDIR,
+              f'No modules found for kernel "{release}"')
+    RELEASE = release
+    LMK = f'lib/modules/{release}'
+    DRIVERS = wildcard(DRIVERS_IN.replace('{LMK}', LMK))
+
+def installed_kernels():
+    try:
+        releases = sorted(os.listdir('/lib/modules'))
+    except FileNotFoundError:
+        return []
+    return [release for release in releases
+            if os.path.isfile(f'/lib/modules/{release}/modules.dep')]
+
 def wildcard(pattern):
     pathes = []
     for row in pattern.split('\n'):
@@ -250,19 +1305,58 @@ def wildcard(pattern):
     return sorted(pathes)
 
 def get_ld_linux():
-    for row in run(f'/usr/bin/ldd {sys.executable}').stdout.split(b'\n'):
-        match = Dependency.regex_ldd_dep.match(row)
-        if match:
-            shared_object = match.groups()[1]
-            if b'/ld-linux' in shared_object:
-                return os.path.realpath(shared_object.decode())
+    try:
+        interpreter = ElfFile(os.path.realpath(sys.executable)).interpreter
+    except (OSError, ValueError, struct.error):
+        return None
+    if interpreter is not None and '/ld-linux' in interpreter:
+        return os.path.realpath(interpreter)
+
+def get_compressor(spec):
+    name, _, level = spec.partition(':')
+    if name not in COMPRESSORS:
+        raise ValueError(f'Unknown compressor "{name}"')
+    compressor, decompressor, default_level = COMPRESSORS[name]
+    level = level or default_level
+    if not level.isdigit():
+        raise ValueError(f'Invalid compression level "{level}"')
+    return [arg.format(level=level) for arg in compressor], decompressor
+
+def parse_size(text):
+    match = re.match(r'^\s*(\d+)\s*([kmgt]?)i?b?\s*$', text, re.I)
+    if match is None:
+        raise ValueError(f'Invalid size "{text}"')
+    number, unit = match.groups()
+    return int(number) * 1024 ** ' kmgt'.index(unit.lower() or ' ')
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return f'{size:.1f} {unit}' if unit != 'B' else f'{size} B'
+        size /= 1024
+    return f'{size:.1f} TiB'
+
+def cpu_time():
+    times = os.times()
+    return times.user + times.system \
+         + times.children_user + times.children_system
+
+def tree_size(path):
+    size, inodes = 0, set()
+    for root, dirs, files in os.walk(path):
+        for fn in dirs + files:
+            st = os.lstat(os.path.join(root, fn))
+            if (st.st_dev, st.st_ino) not in inodes:
+                inodes.add((st.st_dev, st.st_ino))
+                size += st.st_size
+    return size
 
 def run(cmd):
     return subprocess.run(
            cmd, capture_output=True, shell=True, check=True)
 
-def smart_temporary_directory():
-    with tempfile.TemporaryDirectory() as temp_dir:
+def smart_temporary_directory(dir=None):
+    with tempfile.TemporaryDirectory(dir=dir) as temp_dir:
         yield temp_dir
 
 def main():
@@ -271,23 +1365,162 @@ def main():
 
     parser = argparse.ArgumentParser()
     cwd = os.path.abspath(os.getcwd())
-    default_output = os.path.join(cwd,
-                     f'initrfs-{os.uname().release}.img')
+    default_output = os.path.join(cwd, 'initrfs-{release}.img')
     parser.add_argument(
                '-o',
               '--output',
            dest='output',
-           help='Place the output into FILE',
+           help=('Place the output into FILE, "{release}" is replaced '
+                 'by the kernel release'),
         metavar='FILE',
         default=default_output
     )
+    exclusive_group = parser.add_mutually_exclusive_group()
+    exclusive_group.add_argument(
+               '-k',
+              '--kernel',
+           dest='kernel',
+           help=('Build for the kernel RELEASE instead of the running '
+                 'kernel'),
+        metavar='RELEASE'
+    )
+    exclusive_group.add_argument(
+              '--all-kernels',
+           dest='all_kernels',
+           help=('Build images for every kernel in /lib/modules '
+                 'in parallel'),
+         action='store_true'
+    )
+    parser.add_argument(
+              '--modules',
+           dest='module_mode',
+           help=('Decompress kernel modules (default), keep them as '
+                 'shipped where modprobe can load them, or recompress '
+                 'them with zstd (needs a zstd kmod in assets/modprobe)'),
+        choices=['decompress', 'keep', 'zstd'],
+        default='decompress'
+    )
+    parser.add_argument(
+              '--compress',
+           dest='compress',
+           help=('Compress the image with xz (default), zstd, lz4 or '
+                 'gzip, optionally at LEVEL (e.g. zstd:19)'),
+        metavar='NAME[:LEVEL]',
+        default='xz'
+    )
+    parser.add_argument(
+              '--benchmark',
+           dest='benchmark',
+           help=('Compare build time, size and decompression speed of '
+                 'the compressors on the staged tree and exit'),
+          nargs='*',
+        metavar='NAME[:LEVEL]'
+    )
+    parser.add_argument(
+              '--hostonly',
+           dest='hostonly',
+           help=('Only include the modules needed by the hardware and '
+                 'the mounted file systems of this machine, plus the '
+                 'data file systems and zram compressors fresh_os '
+                 'supports'),
+         action='store_true'
+    )
+    group = parser.add_argument_group('report')
+    group.add_argument(
+              '--timings',
+           dest='timings',
+           help='Print the time spent in each build phase',
+         action='store_true'
+    )
+    group.add_argument(
+              '--report-json',
+           dest='report_json',
+           help='Write the build phases and counters to FILE as JSON',
+        metavar='FILE'
+    )
+    group = parser.add_argument_group('cache')
+    group.add_argument(
+              '--cache-dir',
+           dest='cache_dir',
+           help='Reuse unchanged build inputs from the cache in DIR',
+        metavar='DIR'
+    )
+    group.add_argument(
+              '--cache-size',
+           dest='cache_size',
+           help=('Evict the least recently used cache entries '
+                 'beyond SIZE (e.g. 2G)'),
+        metavar='SIZE'
+    )
+    exclusive_group = group.add_mutually_exclusive_group()
+    exclusive_group.add_argument(
+              '--cache-stat',
+           dest='cache_stat',
+           help='Print the cache usage and exit',
+         action='store_true'
+    )
+    exclusive_group.add_argument(
+              '--cache-purge',
+           dest='cache_purge',
+           help=('Evict cache entries down to --cache-size '
+                 '(everything by default) and exit'),
+         action='store_true'
+    )
     opts = parser.parse_args()
-    if os.geteuid() != 0:
-        program = os.path.basename(sys.argv[0])
-        print (f'only root can run "{program}"', file=sys.stderr)
-        sys.exit(errno.EACCES)
     try:
-        build(output=opts.output)
+        cache_size = None if opts.cache_size is None \
+                     else parse_size(opts.cache_size)
+    except ValueError as e:
+        parser.error(str(e))
+    if opts.cache_dir is None:
+        if opts.cache_stat or opts.cache_purge:
+            parser.error('--cache-dir is required')
+        if cache_size is not None:
+            parser.error('--cache-size needs --cache-dir')
+        cache = None
+    else:
+        cache = BuildCache(opts.cache_dir, max_size=cache_size)
+    if opts.cache_stat:
+        objects, images, segments, size = cache.stat()
+        print (f'{cache.cache_dir}: {objects} objects, {images} images, '
+               f'{segments} segments, {format_size(size)}')
+        return
+    elif opts.cache_purge:
+        removed = cache.purge(cache_size or 0)
+        print (f'{format_size(removed)} removed')
+        return
+    try:
+        if opts.kernel is not None:
+            set_kernel(opts.kernel)
+        if opts.benchmark is not None:
+            benchmark(opts.benchmark or BENCHMARK_COMPRESSORS,
+                      module_mode=opts.module_mode, hostonly=opts.hostonly)
+        elif opts.all_kernels:
+            if '{release}' not in opts.output:
+                raise ValueError('--all-kernels requires "{release}" '
+                                 'in the output file name')
+            releases = installed_kernels()
+            if not releases:
+                raise LookupError('No kernels found in /lib/modules')
+            failures, reports = build_kernels(opts.output, releases,
+                                cache=cache, module_mode=opts.module_mode,
+                                hostonly=opts.hostonly,
+                                compress=opts.compress)
+        else:
+            failures, reports = 0, [build(
+                output=opts.output.replace('{release}', RELEASE),
+                cache=cache, module_mode=opts.module_mode,
+                hostonly=opts.hostonly, compress=opts.compress)]
+        if opts.benchmark is None:
+            if opts.timings:
+                for report in reports:
+                    report.print_table()
+            if opts.report_json is not None:
+                with open(opts.report_json, 'w') as f:
+                    json.dump([report.as_dict() for report in reports],
+                              f, indent=2)
+            if failures:
+                sys.exit(errno.EIO)
     except NotADirectoryError as e:
         print (e.strerror, file=sys.stderr)
         sys.exit(errno.ENOTDIR)
@@ -303,10 +1536,12 @@ def main():
     except KeyboardInterrupt:
         sys.exit(0)
 
-LMK = f'lib/modules/{os.uname().release}'
-DRIVERS = wildcard(f'''\
+RELEASE = os.uname().release
+LMK = f'lib/modules/{RELEASE}'
+DRIVERS_IN = '''\
 /usr/bin/strace
 /usr/bin/lsof
+/sbin/e2fsck
 /{LMK}/kernel/fs/aufs
 /{LMK}/kernel/fs/exfat
 /{LMK}/kernel/fs/ext2
@@ -350,7 +1585,63 @@ DRIVERS = wildcard(f'''\
 # copy all custom-built modules
 #/{LMK}/updates  # some drivers may cause boot failure
 /{LMK}/modules.*
-/usr/share/terminfo/l/linux''')
+/usr/share/terminfo/l/linux'''
+DRIVERS = wildcard(DRIVERS_IN.replace('{LMK}', LMK))
+BASE_ASSETS = 'blkid busybox eject micropython'.split()
+# a kmod modprobe replaces the busybox applet when it is provided
+OPTIONAL_ASSETS = ['modprobe']
+MODPROBE_SUFFIXES = {}
+
+BOOTSTRAP_PY = '''#!/bin/micropython
+
+import binascii
+import hashlib
+import os
+import sys
+
+MPY_DIR = '/usr/lib/micropython/mpy'
+
+def is_compiled(name):
+    try:
+        with open(f'{MPY_DIR}/{name}.sha256') as f:
+            expected = f.read().strip()
+        with open(f'/usr/lib/micropython/{name}.py', 'rb') as f:
+            digest = hashlib.sha256(f.read()).digest()
+    except OSError:
+        return False
+    return binascii.hexlify(digest).decode() == expected
+
+if is_compiled('bootstraplib'):
+    sys.path.insert(0, MPY_DIR)
+try:
+    import bootstraplib
+except ValueError:
+    if MPY_DIR not in sys.path:
+        raise
+    sys.path.remove(MPY_DIR)
+    import bootstraplib
+if MPY_DIR in sys.path:
+    os.putenv('MICROPYPATH', f'{MPY_DIR}:.frozen:/usr/lib/micropython')
+
+if "__main__" == __name__:
+    bootstraplib.main()
+'''
+
+HOSTONLY_MODULES = '''\
+loop squashfs overlay fuse zram zsmalloc
+ext2 ext4 f2fs exfat vfat ntfs ntfs3 isofs
+lz4 lz4hc lzo_rle zstd *crc32c* nls_cp437 nls_iso8859_1 nls_utf8
+sd_mod sr_mod usb_storage uas usbhid hid_generic'''.split()
+COMPRESSORS = {
+    'xz': (['xz', '-T0', '-f', '-{level}', '--extreme', '--check=crc32'],
+           ['xz', '-d', '-c'], '6'),
+    'zstd': (['zstd', '-q', '-T0', '--ultra', '-{level}'],
+             ['zstd', '-d', '-q', '-c'], '19'),
+    'lz4': (['lz4', '-q', '-l', '-{level}', '-c'],
+            ['lz4', '-d', '-q', '-c'], '9'),
+    'gzip': (['gzip', '-n', '-{level}'], ['gzip', '-d', '-c'], '9')
+}
+BENCHMARK_COMPRESSORS = 'xz zstd:19 zstd:9 zstd:3 lz4:9 gzip:9'.split()
 
 if '__main__' == __name__:
     main()
@@ -7,6 +7,7 @@ import os
 import re
 import shutil
 import stat
+import struct
 import subprocess
 import sys
 import tempfile
@@ -44,46 +45,269 @@ def save(no_cleanup, yes):
             raise NotADirectoryError(errno.errno.ENOTDIR,
                   f'{base} is not a directory')
     regex_exclude = re.compile('|'.join(EXCLUDE.split('\n')))
-    temp_dir_holder = smart_temporary_directory()
-    temp_dir = next(temp_dir_holder).rstrip('/')
-    out = System('while read FILE; do\n'
-                 f'cp --parents -afr "$FILE" "{temp_dir}"\ndone',
-                 cwd='/run/initramfs/memory/changes')
-    args = ['find', '(', '-type', 'd', '-printf', '%p/\n', ',',
-            '-not', '-type', 'd', '-print', ')']
-    with subprocess.Popen(args,
-         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
-         cwd='/run/initramfs/memory/changes') as proc:
-        for _row in proc.stdout.readlines():
-            row = _row.decode()
-            if not row.startswith('./'):
-                continue
-            row = row[2:]
-            if row.endswith('\r\n'):
-                row = row[:-2]
-            elif row.endswith('\n'):
-                row = row[:-1]
-            if not regex_exclude.search(row):
-                out.write((row+'\n').encode())
-        status = proc.wait()
-        if status != 0:
-            raise OSError(status, 'unable to list changes')
-        status = out.close()
-        if status != 0:
-            raise OSError(status, 'unable to save changes')
+    source = '/run/initramfs/memory/changes'
+    removed = set()
     if not no_cleanup:
-        cleanup(base=temp_dir, ignore_without=True)
-    with tempfile.NamedTemporaryFile() as f:
-        args = ['mksquashfs', temp_dir, f.name, '-comp', 'xz',
+        removed.update(os.path.relpath(path, source) for path, _ in
+                       cleanup_paths(base=source, ignore_without=True))
+    excluded = []
+    scan_changes(source, '', regex_exclude, removed, excluded)
+    if any('\n' in path for path in excluded):
+        # mksquashfs reads one exclude per line, stage a copy instead
+        temp_dir_holder = smart_temporary_directory()
+        source = next(temp_dir_holder).rstrip('/')
+        copy_changes('/run/initramfs/memory/changes', source,
+                     regex_exclude)
+        if not no_cleanup:
+            cleanup(base=source, ignore_without=True)
+        excluded = []
+    with tempfile.NamedTemporaryFile() as f, \
+         tempfile.NamedTemporaryFile('w') as exclude_file:
+        for path in excluded:
+            exclude_file.write(exclude_pattern(path) + '\n')
+        exclude_file.flush()
+        args = ['mksquashfs', source, f.name, '-comp', 'xz',
                 '-b', '1024K', '-Xbcj', 'x86',
-                '-always-use-fragments', '-noappend']
+                '-always-use-fragments', '-noappend',
+                '-wildcards', '-ef', exclude_file.name]
         subprocess.run(args, check=True)
         shutil.copyfile(f.name, output)
+    write_manifest(base.rsplit('/', 1)[0])
+
+def exclude_pattern(path):
+    # -wildcards matches by path, escape what fnmatch expands
+    chars = [re.sub(r'([\\*?[\]+@!(])', r'\\\1', c) for c in path]
+    # mksquashfs strips whitespace around a line, skips lines starting
+    # with # and joins lines ending in \, bracket those to keep them
+    for i in {0, len(path) - 1}:
+        if path[i].isspace() or path[i] in '#\\':
+            chars[i] = f'[{chars[i]}]'
+    return ''.join(chars)
+
+def scan_changes(src, path, exclude, removed, excluded):
+    # mirror the staging copy: directories are only kept as parents of
+    # an accepted entry, everything else is listed for mksquashfs -ef
+    included = False
+    with os.scandir(os.path.join(src, path)) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        rel = os.path.join(path, entry.name)
+        children = []
+        if entry.is_dir(follow_symlinks=False):
+            accepted = scan_changes(src, rel, exclude, removed, children)
+        else:
+            accepted = not exclude.search(rel)
+        # cleanup() ran after the copy, so its parents are still kept
+        included = included or accepted
+        if accepted and rel not in removed:
+            excluded.extend(children)
+        else:
+            excluded.append(rel)
+    return included
+
+def copy_changes(src, dst, exclude, jobs=None):
+
+    import concurrent.futures
+
+    begin = time.monotonic()
+    dst_dev = os.stat(dst).st_dev
+    created, dirs, inodes, links, futures = set(), [], {}, [], []
+    files = size = 0
+    if jobs is None:
+        jobs = min(8, os.cpu_count() or 1)
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        pending = ['']
+        while pending:
+            path = pending.pop()
+            with os.scandir(os.path.join(src, path)) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            for entry in reversed(entries):
+                rel = os.path.join(path, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(rel)
+                    continue
+                if exclude.search(rel):
+                    continue
+                make_parents(src, dst, path, created, dirs)
+                st = entry.stat(follow_symlinks=False)
+                target = os.path.join(dst, rel)
+                files += 1
+                if st.st_nlink > 1:
+                    key = (st.st_dev, st.st_ino)
+                    if key in inodes:
+                        links.append((inodes[key], target))
+                        continue
+                    inodes[key] = target
+                if stat.S_ISREG(st.st_mode):
+                    size += st.st_size
+                    if st.st_dev == dst_dev:
+                        try:
+                            os.link(entry.path, target)
+                            continue
+                        except OSError:
+                            pass
+                    futures.append(pool.submit(copy_regular_file,
+                                               entry.path, target, st))
+                elif stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(entry.path), target)
+                    copy_metadata(entry.path, target, st)
+                else:
+                    os.mknod(target, st.st_mode, st.st_rdev)
+                    copy_metadata(entry.path, target, st)
+        for future in futures:
+            future.result()
+    for src_path, dst_path in links:
+        os.link(src_path, dst_path)
+    for path, st in reversed(dirs):
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    elapsed = max(time.monotonic() - begin, 1e-6)
+    print (f'Copied {files} files, {size / (1 << 20):.1f} MiB '
+           f'in {elapsed:.1f}s ({files / elapsed:.0f} files/s, '
+           f'{size / elapsed / (1 << 20):.1f} MiB/s)')
+    return files, size
+
+def make_parents(src, dst, path, created, dirs):
+    if '' == path or path in created:
+        return
+    make_parents(src, dst, os.path.dirname(path), created, dirs)
+    st = os.lstat(os.path.join(src, path))
+    target = os.path.join(dst, path)
+    os.mkdir(target)
+    copy_metadata(os.path.join(src, path), target, st, times=False)
+    dirs.append((target, st))
+    created.add(path)
+
+def copy_regular_file(src, dst, st):
+    with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+        try:
+            while os.copy_file_range(f_in.fileno(), f_out.fileno(),
+                                     1 << 30):
+                pass
+        except (AttributeError, OSError):
+            f_in.seek(0)
+            f_out.seek(0)
+            f_out.truncate()
+            shutil.copyfileobj(f_in, f_out, 1 << 20)
+    copy_metadata(src, dst, st)
+
+def copy_metadata(src, dst, st, times=True):
+    os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    try:
+        for name in os.listxattr(src, follow_symlinks=False):
+            os.setxattr(dst, name,
+                        os.getxattr(src, name, follow_symlinks=False),
+                        follow_symlinks=False)
+    except OSError:
+        # like cp -a, xattrs are kept where the file systems allow it
+        pass
+    if times:
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns),
+                 follow_symlinks=False)
 
 def print_snapshots():
     for idx, fn in get_snapshots()[1]:
         print (fn)
 
+def timeline(path='/run/initramfs/memory/boot.trace', top=10):
+    spans, stack, bundles = [], [], {}
+    with open(path) as f:
+        rows = f.readlines()
+    for row in rows:
+        seq = row.rstrip('\n').split(' ', 2)
+        if len(seq) != 3:
+            continue
+        try:
+            ts = float(seq[0])
+        except ValueError:
+            continue
+        event, name = seq[1:]
+        if 'begin' == event and name.startswith('mount /'):
+            # bundles are mounted concurrently, they never nest
+            bundles[name] = len(spans)
+            spans.append([name, ts, None, len(stack)])
+        elif 'begin' == event:
+            stack.append(len(spans))
+            spans.append([name, ts, None, len(stack) - 1])
+        elif 'end' == event and name in bundles:
+            spans[bundles.pop(name)][2] = ts
+        elif 'end' == event:
+            for i in reversed(range(len(stack))):
+                if spans[stack[i]][0] == name:
+                    spans[stack[i]][2] = ts
+                    del stack[i]
+                    break
+        elif 'mark' == event:
+            if 'init' == name:
+                spans.append(['kernel, transfer_initramfs', 0.0, ts, 0])
+            else:
+                spans.append([name, ts, ts, len(stack)])
+    if not spans:
+        raise ValueError(f'no boot phases recorded in "{path}"')
+    print ('Boot timeline:')
+    for name, begin, end, depth in spans:
+        duration = '?' if end is None else f'+{end - begin:.3f}s'
+        print (f'{begin:10.3f}s {duration:>10}  {"  " * depth}{name}')
+    bundles = [(end - begin, name[6:]) for name, begin, end, _ in spans
+               if name.startswith('mount /') and end is not None]
+    if bundles:
+        print (f'\nBundle mounts ({len(bundles)}, '
+               f'{sum(cost for cost, _ in bundles):.3f}s):')
+        for cost, bundle in sorted(bundles, reverse=True):
+            print (f'{cost:10.3f}s  {os.path.basename(bundle)}')
+    leaves = [(end - begin, name)
+              for i, (name, begin, end, depth) in enumerate(spans)
+              if end is not None and end > begin
+              and not (i + 1 < len(spans) and spans[i+1][3] > depth)]
+    print ('\nSlowest phases:')
+    for cost, name in sorted(leaves, reverse=True)[:top]:
+        print (f'{cost:10.3f}s  {name}')
+
+def usage(path='/run/initramfs/memory/changes'):
+    mounts, mount = [], None
+    with open('/proc/self/mountinfo') as f:
+        for row in f:
+            seq = row.split()
+            if '-' not in seq[6:]:
+                continue
+            typ, device = seq[seq.index('-', 6) + 1:][:2]
+            mounts.append((seq[2], seq[3], seq[4], typ, device))
+            if path == seq[4]:
+                mount = mounts[-1]
+    if mount is None or not mount[4].startswith('/dev/zram'):
+        st = os.statvfs(path)
+        used = (st.f_blocks - st.f_bfree) * st.f_frsize
+        if mount is None or 'tmpfs' == mount[3]:
+            where = 'in tmpfs'
+        elif mount[1] != '/':
+            # a bind mount of a directory on the data partition
+            top = [mountpoint for dev, root, mountpoint, _, _ in mounts
+                   if dev == mount[0] and '/' == root]
+            where = (f'in {top[0].rstrip("/") if top else ""}{mount[1]} '
+                     f'(directory on {mount[4]}, {mount[3]})')
+        else:
+            where = f'on {mount[4]} ({mount[3]})'
+        print (f'Changes {where}: {used >> 20} MiB used '
+               f'of {st.f_blocks * st.f_frsize >> 20} MiB')
+        return
+    device = mount[4]
+    block = f'/sys/block/{os.path.basename(device)}'
+    with open(f'{block}/mm_stat') as f:
+        data, compressed, used = [int(n) for n in f.read().split()[:3]]
+    with open(f'{block}/comp_algorithm') as f:
+        algorithm = re.search(r'\[(\S+)\]', f.read())
+    with open(f'{block}/disksize') as f:
+        size = int(f.read())
+    print (f'Changes in {device} '
+           f'({algorithm.group(1) if algorithm else "?"}, '
+           f'{size >> 20} MiB):')
+    print (f'{data / (1 << 20):10.1f} MiB  data')
+    print (f'{compressed / (1 << 20):10.1f} MiB  compressed')
+    print (f'{used / (1 << 20):10.1f} MiB  memory used')
+    if compressed:
+        print (f'{data / compressed:10.1f}      compression ratio')
+
 def rollback(yes):
     if os.geteuid() != 0:
         program = os.path.basename(sys.argv[0])
@@ -102,6 +326,127 @@ def rollback(yes):
         yes = prompt(f'\033[0;31mDelete snapshot "{fn}"?\033[0m [y/N]:')
     if yes:
         os.remove(f'{base}/{fn}')
+        write_manifest(base.rsplit('/', 1)[0])
+
+def compact(selection, yes):
+    if os.geteuid() != 0:
+        program = os.path.basename(sys.argv[0])
+        raise PermissionError(
+              errno.EACCES, 'Please use sudo or run the script as root.')
+    base, snapshots = get_snapshots()
+    snapshots_with_index = [(idx, fn)
+                            for idx, fn in snapshots if idx is not None]
+    first, sep, last = selection.partition('..')
+    try:
+        if not sep:
+            raise ValueError
+        first = int(first) if first else None
+        last = int(last) if last else None
+    except ValueError:
+        raise ValueError(f'invalid range "{selection}", '
+                         'expected FROM..TO') from None
+    merging = [(idx, fn) for idx, fn in snapshots_with_index
+               if (first is None or idx >= first)
+               and (last is None or idx <= last)]
+    if len(merging) < 2:
+        raise ValueError('at least two snapshots are needed to compact')
+    idx = merging[0][0]
+    fn = '{:02}-{}'.format(idx, merging[-1][1].split('-', 1)[1])
+    if not yes:
+        yes = prompt(f'Merge {len(merging)} snapshots from '
+                     f'"{merging[0][1]}" to "{merging[-1][1]}" '
+                     f'into "{fn}"? [y/N]:')
+    if not yes:
+        return
+    temp_dir_holder = smart_temporary_directory()
+    temp_dir = next(temp_dir_holder).rstrip('/')
+    staging = os.path.join(temp_dir, 'staging')
+    os.mkdir(staging)
+    blocked = set()
+    for _, layer_fn in reversed(merging):
+        mountpoint = os.path.join(temp_dir, 'layer')
+        os.mkdir(mountpoint)
+        subprocess.run(['mount', '-o', 'loop,ro', '-t', 'squashfs',
+                        f'{base}/{layer_fn}', mountpoint], check=True)
+        try:
+            opaque = set()
+            merge_layer(mountpoint, staging, '', blocked, opaque)
+        finally:
+            subprocess.run(['umount', mountpoint], check=True)
+            os.rmdir(mountpoint)
+        for path in opaque:
+            os.setxattr(os.path.join(staging, path),
+                        'trusted.overlay.opaque', b'y',
+                        follow_symlinks=False)
+        blocked.update(opaque)
+    output = f'{base}/.{fn}.part'
+    args = ['mksquashfs', staging, output, '-comp', 'xz',
+            '-b', '1024K', '-Xbcj', 'x86',
+            '-always-use-fragments', '-noappend']
+    try:
+        subprocess.run(args, check=True)
+    except BaseException:
+        if os.path.exists(output):
+            os.remove(output)
+        raise
+    os.rename(output, f'{base}/{fn}')
+    for _, merged_fn in merging:
+        if merged_fn != fn:
+            os.remove(f'{base}/{merged_fn}')
+    for old_idx, old_fn in snapshots_with_index:
+        if old_idx > merging[-1][0]:
+            idx += 1
+            os.rename(f'{base}/{old_fn}', '{}/{:02}-{}'.format(
+                      base, idx, old_fn.split('-', 1)[1]))
+    write_manifest(base.rsplit('/', 1)[0])
+    print ('The merged snapshot will be used after the next reboot.')
+
+def merge_layer(layer, staging, path, blocked, opaque):
+    for name in sorted(os.listdir(os.path.join(layer, path))):
+        rel = os.path.join(path, name)
+        src, dst = os.path.join(layer, rel), os.path.join(staging, rel)
+        src_st = os.lstat(src)
+        # renamed directories and metadata-only copies point into the
+        # layers below, merging them would lose that data
+        for name in ('trusted.overlay.redirect', 'trusted.overlay.metacopy'):
+            try:
+                os.getxattr(src, name, follow_symlinks=False)
+            except OSError:
+                continue
+            raise ValueError(f'"/{rel}" carries {name}, snapshots made '
+                             'with redirect_dir or metacopy cannot be '
+                             'compacted')
+        try:
+            dst_st = os.lstat(dst)
+        except FileNotFoundError:
+            dst_st = None
+        if dst_st is None:
+            if stat.S_ISDIR(src_st.st_mode):
+                os.mkdir(dst)
+                if is_opaque(src):
+                    opaque.add(rel)
+                merge_layer(layer, staging, rel, blocked, opaque)
+            elif stat.S_ISREG(src_st.st_mode):
+                shutil.copyfile(src, dst)
+            elif stat.S_ISLNK(src_st.st_mode):
+                os.symlink(os.readlink(src), dst)
+            else:
+                os.mknod(dst, src_st.st_mode, src_st.st_rdev)
+            os.chown(dst, src_st.st_uid, src_st.st_gid,
+                     follow_symlinks=False)
+            shutil.copystat(src, dst, follow_symlinks=False)
+        elif stat.S_ISDIR(dst_st.st_mode) and rel not in blocked:
+            if not stat.S_ISDIR(src_st.st_mode) or is_opaque(src):
+                opaque.add(rel)
+            if stat.S_ISDIR(src_st.st_mode):
+                merge_layer(layer, staging, rel, blocked, opaque)
+
+def is_opaque(path):
+    try:
+        return b'y' == os.getxattr(path, 'trusted.overlay.opaque',
+                                   follow_symlinks=False)
+    except OSError:
+        return False
 
 def pack(output, yes):
     if os.geteuid() != 0:
@@ -165,46 +510,34 @@ def export(output):
         os.path.join(base, 'savechanges.py')
     )
 
-class System:
-
-    def __init__(self, cmd, cwd=None):
-        in_, self.out = os.pipe()
-        self.pid = os.fork()
-        if 0 == self.pid:
-            os.close(self.out)
-            os.dup2(in_, 0)
-            os.close(in_)
-            if cwd is not None:
-                os.chdir(cwd)
-            os.system(cmd)
-            os._exit(0)
-        os.close(in_)
-
-    def write(self, b):
-        os.write(self.out, b)
-
-    def close(self):
-        os.close(self.out)
-        return os.waitpid(self.pid, 0)[1]
-
-def get_snapshots():
+def get_home():
 
     import json
 
     with open('/run/initramfs/memory/arguments') as f:
         data = f.read()
     args = json.loads(data)
-    base = f'/run/initramfs{args["home"]}/snapshots'
+    return f'/run/initramfs{args["home"]}'
+
+def get_snapshots():
+    home = get_home()
+    base = f'{home}/snapshots'
     snapshots = []
-    try:
-        files = sorted(os.listdir(base))
-    except FileNotFoundError:
-        return base, snapshots
+    manifest = read_manifest(home)
+    if manifest is not None:
+        files = [bundle['path'].split('/', 1)[1]
+                 for bundle in manifest['bundles']
+                 if bundle['path'].startswith('snapshots/')]
+    else:
+        try:
+            files = sorted(os.listdir(base))
+        except FileNotFoundError:
+            return base, snapshots
     for fn in files:
         root, ext = os.path.splitext(fn)
         if ext.lower() != '.sb':
             continue
-        if not os.path.isfile(f'{base}/{fn}'):
+        if manifest is None and not os.path.isfile(f'{base}/{fn}'):
             continue
         try:
             idx = int(root.split('-', 1)[0])
@@ -214,7 +547,95 @@ def get_snapshots():
             snapshots.append((idx, fn))
     return base, snapshots
 
+def read_manifest(home):
+
+    import json
+
+    try:
+        with open(f'{home}/bundles.json') as f:
+            manifest = json.loads(f.read())
+            mtime = int(os.fstat(f.fileno()).st_mtime)
+        if manifest['version'] != 1 \
+           or int(os.stat(home).st_mtime) != mtime:
+            return None
+        try:
+            snapshots = int(os.stat(f'{home}/snapshots').st_mtime)
+        except FileNotFoundError:
+            snapshots = None
+        if manifest['snapshots'] != snapshots:
+            return None
+        return manifest
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def write_manifest(home):
+
+    import json
+
+    bundles = []
+    for prefix in ('', 'snapshots/'):
+        try:
+            files = sorted(os.listdir(f'{home}/{prefix}'))
+        except FileNotFoundError:
+            continue
+        for fn in files:
+            if not fn.endswith('.sb') or '.sb' == fn:
+                continue
+            path = f'{home}/{prefix}{fn}'
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            bundles.append({    'path': f'{prefix}{fn}',
+                                'size': st.st_size,
+                               'mtime': int(st.st_mtime),
+                            'squashfs': squashfs_info(path) })
+    # Stamp the directories and the manifest with a time in the past, so
+    # any later change in the same (FAT: two) seconds still moves the
+    # mtime of the directory away from the one of the manifest.
+    stamp = (int(time.time()) // 2 - 1) * 2
+    snapshots = stamp if os.path.isdir(f'{home}/snapshots') else None
+    manifest = {   'version': 1,
+                 'snapshots': snapshots,
+                   'bundles': bundles }
+    output = f'{home}/bundles.json'
+    with open(f'{output}.part', 'w') as f:
+        f.write(json.dumps(manifest, indent=1))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(f'{output}.part', output)
+    if snapshots is not None:
+        os.utime(f'{home}/snapshots', (stamp, stamp))
+    os.utime(home, (stamp, stamp))
+    os.utime(output, (stamp, stamp))
+
+def squashfs_info(path):
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(96)
+    except OSError:
+        return None
+    if len(head) < 96 or head[:4] != b'hsqs':
+        return None
+    block_size, = struct.unpack_from('<I', head, 12)
+    compression, = struct.unpack_from('<H', head, 20)
+    bytes_used, = struct.unpack_from('<Q', head, 40)
+    return {  'block_size': block_size,
+             'compression': compression,
+              'bytes_used': bytes_used }
+
 def cleanup(base='/', ignore_without=False):
+    for path, is_dir in cleanup_paths(base, ignore_without):
+        if not os.path.lexists(path):
+            continue
+        elif is_dir:
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+def cleanup_paths(base='/', ignore_without=False):
     files = []
     recursives = []
     for row in CLEANUP.split('\n'):
@@ -235,28 +656,30 @@ def cleanup(base='/', ignore_without=False):
                       os.path.join(base, row), recursive=True))
             else:
                 files.append(os.path.join(base, row))
+    result = []
     for path in sorted(files):
         try:
             st = os.lstat(path)
         except FileNotFoundError:
             continue
         if stat.S_ISREG(st.st_mode):
-            os.remove(path)
+            result.append((path, False))
         elif not ignore_without \
              and stat.S_ISCHR(st.st_mode) and 0 == st.st_rdev:
-            os.remove(path)
+            result.append((path, False))
     for path in sorted(recursives):
         try:
             st = os.lstat(path)
         except FileNotFoundError:
             continue
         if stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
-            os.remove(path)
+            result.append((path, False))
         elif stat.S_ISDIR(st.st_mode):
-            shutil.rmtree(path)
+            result.append((path, True))
         elif not ignore_without \
              and stat.S_ISCHR(st.st_mode) and 0 == st.st_rdev:
-            os.remove(path)
+            result.append((path, False))
+    return result
 
 def prompt(hint, default=False):
     while True:
@@ -309,6 +732,27 @@ def main():
             help='List all snapshots.',
           action='store_true'
     )
+    exclusive_group.add_argument(
+               '--timeline',
+            dest='timeline',
+            help='Print where the last boot spent its time.',
+          action='store_true'
+    )
+    exclusive_group.add_argument(
+               '--usage',
+            dest='usage',
+            help='Print the memory taken by the changes.',
+          action='store_true'
+    )
+    exclusive_group.add_argument(
+               '--compact',
+            dest='compact',
+            help='Merge the snapshots FROM..TO (all by default) '
+                 'into one, an open end as in 5.. runs to the last.',
+           nargs='?',
+           const='..',
+         metavar='FROM..TO'
+    )
     exclusive_group.add_argument(
                 '-r',
                '--rollback',
@@ -336,6 +780,35 @@ def main():
     opts = parser.parse_args()
     if opts.print_snapshots:
         print_snapshots()
+    elif opts.timeline:
+        try:
+            timeline()
+        except FileNotFoundError as err:
+            print (f'{err.strerror}: "{err.filename}"', file=sys.stderr)
+            sys.exit(errno.ENOENT)
+        except ValueError as err:
+            print (str(err), file=sys.stderr)
+            sys.exit(errno.EINVAL)
+    elif opts.usage:
+        try:
+            usage()
+        except OSError as err:
+            print (err.strerror, file=sys.stderr)
+            sys.exit(err.errno)
+    elif opts.compact is not None:
+        try:
+            compact(opts.compact, yes=opts.yes)
+        except PermissionError as err:
+            print (err.strerror, file=sys.stderr)
+            sys.exit(errno.EACCES)
+        except OSError as err:
+            print (err.strerror, file=sys.stderr)
+            sys.exit(err.errno)
+        except ValueError as err:
+            print (str(err), file=sys.stderr)
+            sys.exit(errno.EINVAL)
+        except subprocess.CalledProcessError as err:
+            sys.exit(err.returncode)
     elif opts.rollback is not None:
         parser = argparse.ArgumentParser(
                  prog=f'{parser.prog} --rollback',